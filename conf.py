@@ -4,6 +4,32 @@ DB = {
 	'user' : 'memeuser',    # Username for Poseqres
 	'pass' : 'memepswd',    # Password for Poseqres
 	'name' : 'memedb',      # Database name for Poseqres
+	'pool_min' : 1,         # Connections opened when the pool starts
+	'pool_max' : 10,        # Most connections checked out at once
+	'pool_ping' : False,    # Run SELECT 1 before reusing a connection
+	'key_cache' : 65536,    # Most key<->id pairs cached per graph
+	'key_preload' : 0,      # Most used keys loaded when a graph's cache starts
+	'key_sql' : False,      # Resolve keys inside the query SQL (one round-trip)
+	'fetch_size' : 1000,    # Rows per fetch for query_iter()
+	'plan_cache' : 256,     # Most cached query plans (0 disables)
+	'plan_prepare' : False, # Run cached plans as server-side PREPARE/EXECUTE
+	'sql_opt' : False,      # Query SQL with EXISTS semi-joins and a single final dedup
+	'copy_batch' : 10000,   # Lines per COPY batch for bulk loading
+	'id_block' : 1000,      # New key IDs reserved per sequence call
+	'join_order' : True,    # Run the most selective clause group of a query first
+	'stats_ttl' : 300,      # Seconds before join order statistics and built paths are reloaded
+	'mem_gids' : [],        # Graphs queried from an in-memory MemGraph
+	'result_cache' : 0,     # Most cached query()/count() results (0 disables)
+	'result_ttl' : 60,      # Seconds a cached result lives (0 for no limit)
+	'result_store' : None,  # SQLite file shared by processes, e.g. /dev/shm/memecache.db
+	'timing' : False,       # Time each query stage into timingstats()
+	'slow_ms' : 0,          # Log queries slower than this (0 disables)
+	'slow_explain' : False, # Add EXPLAIN (ANALYZE, BUFFERS) to slow query logs
+	'slow_log' : None,      # File for slow queries as JSON lines
+	'slow_keep' : 100,      # Slow queries kept in memory
+	'partition' : None,     # Partition tables on gid: 'list' (graphpart per graph) or 'hash'
+	'part_hash' : 16,       # Partitions when partition is 'hash'
+	'paths' : [],           # Hot two-hop relation chains kept as path tables, e.g. ['birth[year'] (then run pathadd)
 	'table_meme' :'meme',
 	'table_impl' :'impl',
 	'table_name' :'name'
@@ -3,19 +3,42 @@
 import sys
 import os
 import re
+import asyncio
+import bisect
+import contextlib
 import glob
+import json
+import functools
+import io
+import itertools
+import mmap
+import multiprocessing
+import random
+import sqlite3
+import struct
+import threading
+import time
+import timeit
+import tracemalloc
+import weakref
 import psycopg2
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from conf import DB
 
+try: import numpy
+except ImportError: numpy = None
+
+try: import asyncpg
+except ImportError: asyncpg = None
+
 
 ###############################################################################
 #                           CONSTANTS & GLOBALS
 ###############################################################################
 
-AID = {}
-
-# Global dictionary to cache key->id mappings
-
 GID = 999 # Default graph ID
 G = 1 # Virtual graph for names of operators
 
@@ -76,6 +99,9 @@ OPR = {
 	I['|']  : [OR, INTEGER, False],
 }
 
+# Operator text for encode()
+OPOUT = {op: K[op] if OPR[op][OUT]==False else OPR[op][OUT] for op in OPR}
+
 # For decode()
 INCOMPLETE, SEMICOMPLETE, COMPLETE = 1, 2, 3
 OPSTR = {
@@ -97,6 +123,14 @@ OPSTR = {
 	'|'   : [COMPLETE, I['|']],
 }
 
+# Lexemes for decode(): operand run, spaces, newline or semicolon, operator character
+LEXER = re.compile(r'([^#;\[\]|!><=:\s]+)|([^\S\n]+)|([;\n])|(.)')
+COMMENT = re.compile(r'\s*//.*$', flags=re.MULTILINE)
+QUOTE = re.compile(r'(?<!\\)"')
+STRIPOPS = frozenset('#;!<>=|') # Spaces next to these are dropped
+ALNUM = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+DIGITS = frozenset('0123456789')
+
 
 ###############################################################################
 #                       MEMELANG STRINGING PROCESSING
@@ -104,8 +138,100 @@ OPSTR = {
 
 # Input: Memelang string "operator1operand1operator2operand2"
 # Output: [operator1, operand1, operator2, operand2, ...]
+# One pass over LEXER lexemes, same tokens as decode_re()
 def decode(memestr: str) -> list:
 
+	if '//' in memestr: memestr = COMMENT.sub('', memestr) # Remove comments
+	memestr = memestr.strip()
+	if len(memestr) == 0: raise Exception("Error: Empty query provided.")
+
+	tokens = [G, G]
+
+	# Key/Integer/Decimal
+	def operand(strtok: str):
+		if tokens[-1]!=None: raise Exception(f'Sequence error {tokens[-2]} {tokens[-1]} {strtok}')
+		if ALNUM.isdisjoint(strtok): raise Exception(f"Unexpected '{strtok}' in {memestr}")
+		if OPR[tokens[-2]][FORM]==DECIMAL: tokens[-1] = float(strtok)
+		elif (strtok[1:2] if strtok[0]=='-' else strtok[0]) in DIGITS: tokens[-1] = int(strtok)
+		else: tokens[-1] = strtok
+
+	# > < = ! that did not join the next lexeme
+	def single(opstr: str):
+		completeness, operator = OPSTR[opstr]
+		if completeness==INCOMPLETE: raise Exception(f"Invalid strtok {opstr}")
+		tokens.extend((operator, None))
+
+	src = ';'+memestr
+	slen = len(src)
+	beg, quoted = 0, False
+	while beg <= slen:
+
+		# Next unescaped quote
+		end = src.find('"', beg)
+		while end > 0 and src[end-1] == '\\': end = src.find('"', end+1)
+		if end < 0: end = slen
+
+		# Quote
+		if quoted:
+			if OPR[tokens[-2]][FUNC] != Q: raise Exception('Errant quote')
+			tokens[-2], tokens[-1] = I['=$'], src[beg:end]
+
+		# Memelang code
+		# semi: pending ; (runs collapse, dropped at the end)
+		# space: pending ' ' (dropped next to STRIPOPS)
+		# pend: > < = ! waiting to join the next lexeme, such as > and =
+		else:
+			semi = space = strip = False
+			pend = None
+			for lex in LEXER.finditer(src, beg, end):
+				kind = lex.lastindex
+				if kind == 2:
+					if not semi and not strip: space = True
+					continue
+				elif kind == 3:
+					semi, space = True, False
+					continue
+
+				strtok = lex.group(kind)
+				if semi:
+					if pend: single(pend)
+					pend, semi = None, False
+					tokens.extend((I[';'], None))
+				elif space:
+					if strtok not in STRIPOPS: tokens.extend((I[' '], None))
+					space = False
+
+				if pend:
+					if OPSTR.get(pend+strtok):
+						tokens.extend((OPSTR[pend+strtok][1], None))
+						pend, strip = None, kind == 4
+						continue
+					single(pend)
+					pend = None
+
+				# Operator
+				if kind == 4 and OPSTR.get(strtok):
+					strip = strtok in STRIPOPS
+					if OPSTR[strtok][0]==COMPLETE: tokens.extend((OPSTR[strtok][1], None))
+					else: pend = strtok
+
+				# Key/Integer/Decimal, or an errant # :
+				else:
+					strip = strtok in STRIPOPS
+					operand(strtok)
+
+			if pend: single(pend)
+			elif space: tokens.extend((I[' '], None))
+
+		quoted = not quoted
+		beg = end+1
+
+	return tokens
+
+
+# Regex decode(), kept as the reference for cli_dectest()
+def decode_re(memestr: str) -> list:
+
 	memestr = re.sub(r'\s*//.*$', '', memestr, flags=re.MULTILINE).strip() # Remove comments
 	if len(memestr) == 0: raise Exception("Error: Empty query provided.")
 
@@ -180,13 +306,17 @@ def nxt(tokens: list, beg: int = 2) -> int:
 
 
 # Compare two Memelang token lists
+# With beg, compare the len(btoks) tokens of atoks from beg, like atoks[beg:beg+len(btoks)] without the copy
 # False is wildcard
 # TO DO: This needs its own Metamemelang query language
-def tokfit (atoks: list, btoks: list) -> bool:
-	if len(atoks)!=len(btoks): return False
-	for p, btok in enumerate(btoks):
+def tokfit (atoks: list, btoks: list, beg: int = None) -> bool:
+	if beg is None:
+		if len(atoks)!=len(btoks): return False
+		beg = 0
+	elif beg<0 or len(atoks)-beg<len(btoks): return False
+	for p, btok in enumerate(btoks, beg):
 		if btok==False: continue
-		elif p%2==0 and isinstance(btok, str):
+		elif (p-beg)%2==0 and isinstance(btok, str):
 			if OPR[atoks[p]][FUNC]!=btok: return False
 		elif atoks[p]!=btok: return False
 	return True
@@ -235,33 +365,250 @@ def unpack(bigint: int) -> list:
 	return pairs
 
 
+# Operators whose operand pack() scales by 1000000
+DECIMALS = frozenset(op for op in OPR if OPR[op][FORM]==DECIMAL)
+
+
+# Input: list of token lists
+# Output: flat array('Q') of 64-bit words, array('Q') of len+1 word offsets
+# Words match pack() minus its version word, first pair first
+# Uses NumPy when installed
+def packs(tokenlists: list) -> tuple[array, array]:
+	operators, operands, offsets = [], [], array('Q', [0])
+	for tokens in tokenlists:
+		if len(tokens)%2: raise ValueError('Odd token count')
+		operators.extend(tokens[START::2])
+		operands.extend(tokens[START+1::2])
+		offsets.append(len(operators))
+
+	operands = [0 if operand is None else int(operand*1000000) if operator in DECIMALS else operand for operator, operand in zip(operators, operands)]
+
+	words = array('Q')
+	if numpy:
+		ops = numpy.array(operators, dtype=numpy.int64)
+		nums = numpy.array(operands, dtype=numpy.int64)
+		bad = (ops<0)|(ops>=127)
+		if bad.any(): raise ValueError(f'operator range {ops[bad][0]}')
+		bad = (nums<(-1<<56))|(nums>=(1<<56))
+		if bad.any(): raise ValueError(f'operand range {nums[bad][0]}')
+		words.frombytes(((ops.astype(numpy.uint64)<<numpy.uint64(57))|(nums.view(numpy.uint64)&numpy.uint64((1<<57)-1))).tobytes())
+	else:
+		for operator, operand in zip(operators, operands):
+			if not (0<=operator<127): raise ValueError(f'operator range {operator}')
+			if not (-1<<56<=operand<1<<56): raise ValueError(f'operand range {operand}')
+			words.append((operator<<57)|(operand&((1<<57)-1)))
+
+	return words, offsets
+
+
+# Input: words and offsets from packs(), as arrays or any buffer such as bytes or mmap
+# Output: list of token lists, as unpack() would return for each
+# Reads the buffers in place
+def unpacks(words, offsets) -> list:
+	words, offsets = memoryview(words), memoryview(offsets)
+	if words.format != 'Q': words = words.cast('B').cast('Q')
+	if offsets.format != 'Q': offsets = offsets.cast('B').cast('Q')
+
+	if numpy:
+		wrd = numpy.frombuffer(words, dtype=numpy.uint64)
+		ops = (wrd>>numpy.uint64(57)).astype(numpy.int64)
+		nums = (wrd&numpy.uint64((1<<57)-1)).astype(numpy.int64)
+		nums[nums>=(1<<56)] -= 1<<57
+		operators, operands = ops.tolist(), nums.tolist()
+	else:
+		operators, operands = [], []
+		for word in words:
+			operand = word&((1<<57)-1)
+			operators.append(word>>57)
+			operands.append(operand-(1<<57) if operand>=(1<<56) else operand)
+
+	operands = [None if operand==0 else float(operand/1000000) if operator in DECIMALS else operand for operator, operand in zip(operators, operands)]
+
+	tokenlists = []
+	for i in range(len(offsets)-1):
+		beg, end = offsets[i], offsets[i+1]
+		tokens = [G, G] + [None]*(2*(end-beg))
+		tokens[START::2], tokens[START+1::2] = operators[beg:end], operands[beg:end]
+		tokenlists.append(tokens)
+	return tokenlists
+
+
+# Input: words and offsets from packs(), record number
+# Output: the same big integer pack() returns for that record
+def packword(words, offsets, i: int) -> int:
+	bigint = 1<<63
+	for t in range(offsets[i+1]-1, offsets[i]-1, -1): bigint = (bigint<<64)|words[t]
+	return bigint
+
+
 # Input: tokens [operator1, operand1, operator2, operand2, ...]
 # Output: Memelang string "operator1operand1operator2operand2"
 def encode(tokens: list, fset={}) -> str:
-	memestr = ''
+	parts = []
 	for o in range(START, len(tokens), 2):
-		if o>START or tokens[o]!=I[';']: memestr += K[tokens[o]] if OPR[tokens[o]][OUT]==False else OPR[tokens[o]][OUT]
-		if OPR[tokens[o]][FORM] == STRING: memestr += str(tokens[o+1]) + '"'
-		elif OPR[tokens[o]][FORM] != NULL and tokens[o+1] is not None: memestr += str(tokens[o+1])
-	return memestr
+		operator, operand = tokens[o], tokens[o+1]
+		form = OPR[operator][FORM]
+		if o>START or operator!=I[';']: parts.append(OPOUT[operator])
+		if form == STRING: parts.append(str(operand) + '"')
+		elif form != NULL and operand is not None: parts.append(str(operand))
+	return ''.join(parts)
 
 
 ###############################################################################
 #                        DATABASE HELPER FUNCTIONS
 ###############################################################################
 
-def select(sql: str, params: list = []) -> list:
-	with psycopg2.connect(f"host={DB['host']} dbname={DB['name']} user={DB['user']} password={DB['pass']}") as conn:
-		cursor = conn.cursor()
-		cursor.execute(sql, params)
-		rows=cursor.fetchall()
-		return [list(row) for row in rows]
+# Pooled connections shared by all DB helpers
+POOL = {'conns': [], 'used': 0, 'open': False, 'opened': 0, 'reused': 0}
+POOL_LOCK = threading.Condition()
+
+
+# A forked child starts with an empty pool
+# Closing the parent's connections from here would break them for the parent
+def pool_forget():
+	global POOL_LOCK
+	POOL_LOCK = threading.Condition()
+	POOL.update({'conns': [], 'used': 0, 'open': False})
+
+
+if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=pool_forget)
+
+
+# Open a new Postgres connection
+def connect():
+	conn = psycopg2.connect(f"host={DB['host']} dbname={DB['name']} user={DB['user']} password={DB['pass']}")
+	with POOL_LOCK: POOL['opened'] += 1
+	return conn
+
+
+# Is an idle pooled connection safe to hand out again?
+def healthy(conn) -> bool:
+	if conn.closed: return False
+	if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE: return False
+	if DB.get('pool_ping'):
+		try:
+			with conn.cursor() as cursor: cursor.execute('SELECT 1')
+			conn.rollback()
+		except psycopg2.Error: return False
+	return True
+
+
+# Warm up the pool with DB['pool_min'] idle connections
+def open_pool():
+	with POOL_LOCK:
+		if POOL['open']: return
+		POOL['open'] = True
+	conns = [connect() for _ in range(DB.get('pool_min', 1))]
+	with POOL_LOCK:
+		POOL['conns'].extend(conns)
+		POOL_LOCK.notify_all()
+
+
+# Close every idle connection
+# Connections checked out right now are closed when returned
+def close_pool():
+	with POOL_LOCK:
+		conns, POOL['conns'], POOL['open'] = POOL['conns'], [], False
+	for conn in conns:
+		if not conn.closed: conn.close()
+
+
+# Take a connection from the pool, blocking while DB['pool_max'] are in use
+def checkout():
+	open_pool()
+	with POOL_LOCK:
+		while not POOL['conns'] and POOL['used'] >= DB.get('pool_max', 10): POOL_LOCK.wait()
+		conn = POOL['conns'].pop() if POOL['conns'] else None
+		POOL['used'] += 1
+
+	# Check idle connections outside the lock, healthy() may ping the server
+	while conn:
+		if healthy(conn):
+			with POOL_LOCK: POOL['reused'] += 1
+			return conn
+		if not conn.closed: conn.close()
+		with POOL_LOCK: conn = POOL['conns'].pop() if POOL['conns'] else None
+
+	try: return connect()
+	except Exception:
+		with POOL_LOCK:
+			POOL['used'] -= 1
+			POOL_LOCK.notify()
+		raise
+
+
+# Return a connection to the pool
+def checkin(conn):
+	keep = False
+	with POOL_LOCK:
+		POOL['used'] -= 1
+		if not conn.closed and POOL['open'] and len(POOL['conns']) < DB.get('pool_max', 10):
+			POOL['conns'].append(conn)
+			keep = True
+		POOL_LOCK.notify()
+	if not keep and not conn.closed: conn.close()
+
+
+# Borrow a pooled connection, commit on success, roll back on error
+@contextmanager
+def pooled():
+	conn = checkout()
+	try:
+		yield conn
+		conn.commit()
+	except BaseException:
+		if not conn.closed: conn.rollback()
+		raise
+	finally: checkin(conn)
+
+
+# Output: {'opened': int, 'reused': int, 'idle': int, 'used': int}
+def pool_stats() -> dict:
+	with POOL_LOCK: return {'opened': POOL['opened'], 'reused': POOL['reused'], 'idle': len(POOL['conns']), 'used': POOL['used']}
+
+
+# Names of the statements PREPAREd on each pooled connection
+PREPARED = weakref.WeakKeyDictionary()
+
+
+# Input: SQL with %s parameters
+# Output: SQL with $1, $2, ... parameters
+def dollarify(sql: str) -> str:
+	num = itertools.count(1)
+	return re.sub(r'%s', lambda _: f"${next(num)}", sql)
+
+
+# Run sql once as PREPARE name, then EXECUTE name on this connection
+def prepexec(cursor, name: str, sql: str, params: list):
+	conn = cursor.connection
+	names = PREPARED.setdefault(conn, set())
+	if name not in names:
+		if len(names) >= DB.get('plan_cache', 256):
+			cursor.execute('DEALLOCATE ALL')
+			names.clear()
+		cursor.execute(f"PREPARE {name} AS " + dollarify(sql))
+		names.add(name)
+	cursor.execute(f"EXECUTE {name} (" + ','.join(['%s'] * len(params)) + ")" if params else f"EXECUTE {name}", params)
+
+
+# prep names a server-side prepared statement for sql
+def select(sql: str, params: list = [], prep: str = None) -> list:
+	with timing('select', {'sql': sql, 'params': params}) as info:
+		with pooled() as conn:
+			with conn.cursor() as cursor:
+				if prep: prepexec(cursor, prep, sql, params)
+				else: cursor.execute(sql, params)
+				rows=cursor.fetchall()
+		info['rows'] = len(rows)
+	return [list(row) for row in rows]
 
 
 def insert(sql: str, params: list = []):
-	with psycopg2.connect(f"host={DB['host']} dbname={DB['name']} user={DB['user']} password={DB['pass']}") as conn:
-		cursor = conn.cursor()
-		cursor.execute(sql, params)
+	with timing('insert', {'sql': sql, 'params': params}) as info:
+		with pooled() as conn:
+			with conn.cursor() as cursor:
+				cursor.execute(sql, params)
+				info['rows'] = cursor.rowcount
 
 
 def aggnum(col: str = 'aid', agg: str = 'MAX', table: str = None) -> int:
@@ -277,6 +624,7 @@ def selectin(cols: dict = {}, table: str = None) -> list:
 	params = []
 
 	for col in cols:
+		if not cols[col]: return [] # IN () matches nothing
 		conds.append(f"{col} IN ("+ ','.join(['%s'] * len(cols[col])) +")")
 		params.extend(cols[col])
 
@@ -285,10 +633,40 @@ def selectin(cols: dict = {}, table: str = None) -> list:
 	return select(f"SELECT DISTINCT * FROM {table} WHERE " + ' AND '.join(conds), params)
 
 
+# Values loaded for the caches of cacheload(), by (id of the cache, gid)
+LOADING = set()
+LOADS_LOCK = threading.Lock()
+
+
+# Input: cache of {gid: (load time, value)}, graph ID, load(gid), seconds a value lives, wait to load it here
+# Output: the cached value, or None until its first load finishes
+# One background thread reloads a missing or stale value while callers keep the old one, so no query waits on it
+def cacheload(cache: dict, gid: int, load, ttl: float, wait: bool = False):
+	with LOADS_LOCK:
+		entry = cache.get(gid)
+		if entry and time.time()-entry[0] < ttl: return entry[1]
+		if not wait:
+			if (id(cache), gid) in LOADING: return entry[1] if entry else None
+			LOADING.add((id(cache), gid))
+
+	def run():
+		try:
+			value = load(gid)
+			with LOADS_LOCK: cache[gid] = (time.time(), value)
+			return value
+		finally:
+			if not wait:
+				with LOADS_LOCK: LOADING.discard((id(cache), gid))
+
+	if wait: return run()
+	threading.Thread(target=run, daemon=True).start()
+	return entry[1] if entry else None
+
+
 # Conbine SQL and parameters into a string
 def morfigy(sql: str, params: list) -> str:
     for param in params:
-        rep = param.replace("'", "''") if isinstance(param, str) else str(param)
+        rep = "'" + param.replace("'", "''") + "'" if isinstance(param, str) else str(param)
         sql = sql.replace("%s", rep, 1)
     return sql
 
@@ -299,101 +677,345 @@ def slugify(string: str) -> str:
 	return re.sub(r'__+', '_', re.sub(r'[^a-z0-9]', '_', string.lower())).strip('_')
 
 
+###############################################################################
+#                              INSTRUMENTATION
+###############################################################################
+
+# With DB['timing'] set, or any hook added, each stage is timed into TIMINGS
+# Stages: decode, identify, querify, select, insert, keyify, rowify, derive
+# Callbacks get (stage, seconds, info) after each stage, where info['async'] marks asyncpg selects and inserts
+# Spans are context managers, entered with (stage, info) around each stage, for tracers
+HOOKS = {'callbacks': [], 'spans': []}
+TIMINGS = {}
+TIMINGS_LOCK = threading.Lock()
+
+# Histogram bucket upper bounds in milliseconds
+TIMING_BUCKETS = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000, float('inf'))
+
+# Slowest recent queries, and a lock for DB['slow_log']
+SLOW = []
+SLOW_LOCK = threading.Lock()
+
+
+# Input: callback(stage, seconds, info), or span(stage, info) with span=True
+def addhook(func, span: bool = False):
+	HOOKS['spans' if span else 'callbacks'].append(func)
+
+
+def delhook(func):
+	for funcs in HOOKS.values():
+		if func in funcs: funcs.remove(func)
+
+
+# Time the block as stage, adding to TIMINGS and calling the hooks
+# info is a dict the block may fill, such as with row counts
+@contextmanager
+def timing(stage: str, info: dict = None):
+	if not (DB.get('timing') or HOOKS['callbacks'] or HOOKS['spans']):
+		yield info
+		return
+
+	if info is None: info = {}
+	with contextlib.ExitStack() as spans:
+		for span in HOOKS['spans']: spans.enter_context(span(stage, info))
+		start = time.perf_counter()
+		try: yield info
+		finally:
+			secs = time.perf_counter() - start
+			bucket = bisect.bisect_left(TIMING_BUCKETS, secs*1000)
+			with TIMINGS_LOCK:
+				stat = TIMINGS.setdefault(stage, {'count': 0, 'secs': 0.0, 'max': 0.0, 'hist': [0]*len(TIMING_BUCKETS)})
+				stat['count'] += 1
+				stat['secs'] += secs
+				stat['max'] = max(stat['max'], secs)
+				stat['hist'][bucket] += 1
+			for callback in HOOKS['callbacks']: callback(stage, secs, info)
+
+
+# Output: {stage: {'count', 'ms', 'avg_ms', 'max_ms', 'hist': {'<=ms': count}}}
+def timingstats() -> dict:
+	with TIMINGS_LOCK: stats = {stage: {**stat, 'hist': list(stat['hist'])} for stage, stat in TIMINGS.items()}
+	return {stage: {
+		'count': stat['count'],
+		'ms': stat['secs']*1000,
+		'avg_ms': stat['secs']*1000/stat['count'],
+		'max_ms': stat['max']*1000,
+		'hist': {f"<={bound:g}": cnt for bound, cnt in zip(TIMING_BUCKETS, stat['hist']) if cnt},
+	} for stage, stat in stats.items()}
+
+
+def timingclear():
+	with TIMINGS_LOCK: TIMINGS.clear()
+
+
+# Input: Memelang string, its SQL, params, and result rows, seconds it took
+# Queries over DB['slow_ms'] are kept in SLOW (the last DB['slow_keep']) and appended to DB['slow_log'] as JSON lines
+# DB['slow_explain'] adds EXPLAIN (ANALYZE, BUFFERS), which runs the query again
+def slowlog(memestr: str, sql: str, params: list, rows: list, secs: float):
+	if not DB.get('slow_ms') or secs*1000 < DB['slow_ms']: return
+
+	entry = {
+		'time': time.time(),
+		'ms': round(secs*1000, 3),
+		'memelang': memestr,
+		'sql': morfigy(sql, params),
+		'rows': len(rows),
+		'bytes': sum(len(str(col)) for row in rows for col in row if col is not None),
+	}
+	if DB.get('slow_explain'): entry['explain'] = '\n'.join(row[0] for row in select('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params))
+
+	with SLOW_LOCK:
+		SLOW.append(entry)
+		del SLOW[:-DB.get('slow_keep', 100)]
+		if DB.get('slow_log'):
+			with open(DB['slow_log'], 'a', encoding='utf-8') as f: f.write(json.dumps(entry) + '\n')
+
+
 ###############################################################################
 #                           KEY <-> ID CONVERSIONS
 ###############################################################################
 
-# Input list of key strings ['george_washington', 'john_adams']
-# Load key->aids in I and K caches
-# I['john_adams']=123
-# K[123]='john_adams'
-def identify(tokens: list, gids: list[int] = []) -> list:
+# Size-capped LRU of key<->id pairs for one graph
+class KeyCache:
+	def __init__(self, size: int = 65536):
+		self.size = size
+		self.ids = OrderedDict()	# key -> id, oldest first
+		self.keys = {}				# id -> key
+		self.hits = self.misses = self.evictions = 0
+		self.lock = threading.Lock()
+
+	def id(self, key: str) -> int:
+		with self.lock:
+			iid = self.ids.get(key)
+			if iid is None: self.misses += 1
+			else:
+				self.hits += 1
+				self.ids.move_to_end(key)
+			return iid
+
+	def key(self, iid: int) -> str:
+		with self.lock:
+			key = self.keys.get(iid)
+			if key is None: self.misses += 1
+			else:
+				self.hits += 1
+				self.ids.move_to_end(key)
+			return key
+
+	def add(self, key: str, iid: int):
+		with self.lock:
+			if key in self.ids: self.keys.pop(self.ids[key], None)
+			if iid in self.keys: self.ids.pop(self.keys[iid], None)
+			self.ids[key] = iid
+			self.keys[iid] = key
+			self.ids.move_to_end(key)
+			while len(self.ids) > self.size:
+				oldkey, oldid = self.ids.popitem(last=False)
+				self.keys.pop(oldid, None)
+				self.evictions += 1
+
+	def clear(self):
+		with self.lock:
+			self.ids.clear()
+			self.keys.clear()
+
+	def stats(self) -> dict:
+		with self.lock: return {'size': len(self.ids), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+# One KeyCache per graph ID
+KEYS = {}
+KEYS_LOCK = threading.Lock()
+
+
+# Input: graph ID
+# Output: that graph's KeyCache, created (and optionally preloaded) on first use
+def keycache(gid: int) -> KeyCache:
+	with KEYS_LOCK:
+		cache = KEYS.get(gid)
+		if cache: return cache
+		cache = KEYS[gid] = KeyCache(DB.get('key_cache', 65536))
+	if DB.get('key_preload'): keypreload(gid, DB['key_preload'])
+	return cache
+
+
+# Load the most used keys of a graph into its cache
+# Usage counts over aid, rid and bid in the meme table
+def keypreload(gid: int, limit: int = 1000) -> int:
+	meme_table, name_table = DB['table_meme'], DB['table_name']
+	rows = select(f"""SELECT n.aid, n.qnt FROM {name_table} n JOIN (
+		SELECT iid, COUNT(*) AS cnt FROM (
+			SELECT aid AS iid FROM {meme_table} WHERE gid=%s
+			UNION ALL SELECT rid FROM {meme_table} WHERE gid=%s
+			UNION ALL SELECT bid FROM {meme_table} WHERE gid=%s
+		) u GROUP BY iid ORDER BY cnt DESC LIMIT %s
+	) h ON n.aid=h.iid WHERE n.gid=%s AND n.rid=%s AND n.bid=%s ORDER BY h.cnt""", [gid, gid, gid, int(limit), gid, I['nam'], I['key']])
+	cache = keycache(gid)
+	for row in rows: cache.add(row[1], int(row[0]))
+	return len(rows)
+
+
+# Output: {gid: KeyCache.stats()}
+def keystats() -> dict:
+	with KEYS_LOCK: caches = dict(KEYS)
+	return {gid: cache.stats() for gid, cache in caches.items()}
+
+
+# Input: key strings ['george_washington', 'john_adams']
+# Output: {'george_washington': 123, 'john_adams': 124}
+# Operator names in I win, then earlier gids over later gids
+# lookup=False only answers from the caches
+def keyids(keys, gids: list[int] = [], lookup: bool = True) -> dict:
 	if not gids: gids = [GID]
-	allaids=I
+	found, lookups = keyfind(keys, gids)
+	if lookups and lookup: keyrows(selectin({'qnt':lookups.keys(), 'rid':[I['nam']], 'bid':[I['key']], 'gid':gids}, DB['table_name']), gids, found)
+	return found
+
+
+# Input: keys or IDs, graph IDs, byid for IDs
+# Output: {key: id} (or {id: key}) found without the DB, {key: 1} left to look up
+def keyfind(keys, gids: list[int], byid: bool = False) -> tuple[dict, dict]:
+	found, lookups = {}, {}
+	for key in keys:
+		if key in found: continue
+		val = (K if byid else I).get(key)
+		if val is None:
+			for gid in gids:
+				val = keycache(gid).key(key) if byid else keycache(gid).id(key)
+				if val is not None: break
+		if val is None: lookups[key] = 1
+		else: found[key] = val
+	return found, lookups
+
+
+# Input: name table rows from a lookup, graph IDs, dict from keyfind() to fill
+# Caches every row, then fills found in gid order
+def keyrows(rows: list, gids: list[int], found: dict, byid: bool = False):
+	bygid = {}
+	for row in rows:
+		keycache(int(row[0])).add(row[4], int(row[1]))
+		if byid: bygid.setdefault(int(row[0]), {})[int(row[1])] = row[4]
+		else: bygid.setdefault(int(row[0]), {})[row[4]] = int(row[1])
+
+	# must keep gid order
 	for gid in gids:
-		if not AID.get(gid): AID[gid]={}
-		for q, a in AID[gid].items(): allaids.setdefault(q, a)
+		for key, val in bygid.get(gid, {}).items(): found.setdefault(key, val)
 
-	tlen = len(tokens)
-	if not tlen: return tokens
 
-	lookups={}
-	tokids=[G, gids[-1]]
+# Input: ID numbers [123, 124]
+# Output: {123: 'george_washington', 124: 'john_adams'}
+# lookup=False only answers from I and the caches
+def idkeys(iids, gids: list[int] = [], lookup: bool = True) -> dict:
+	if not gids: gids = [GID]
+	found, lookups = keyfind(iids, gids, True)
+	if lookups and lookup: keyrows(selectin({'aid':lookups.keys(), 'rid':[I['nam']], 'bid':[I['key']], 'gid':gids}, DB['table_name']), gids, found, True)
+	return found
 
-	for t in range(START, tlen, 2):
-		operator, operand = tokens[t], tokens[t+1]
-		if isinstance(operand, str) and OPR[operator][FORM]==KEY:
-			operand=operand.lstrip('-')
-			if not allaids.get(operand): lookups[operand]=1
 
-	if lookups:
-		rows=selectin({'qnt':lookups.keys(), 'rid':[I['nam']], 'bid':[I['key']], 'gid':gids}, DB['table_name'])
-		for row in rows: AID[int(row[0])][row[4]] = int(row[1])
+# IDs reserved from the sequence but not yet handed out, for this process
+# top is the highest ID this process has seen the sequence hand out
+IDS = {'pid': 0, 'free': [], 'top': 0}
+IDS_LOCK = threading.Lock()
 
-		# must keep gid order
-		for gid in gids:
-			for q, a in AID[gid].items(): allaids.setdefault(q, a)
 
-	for t in range(START, tlen, 2):
-		operator, operand = tokens[t], tokens[t+1]
-		tokids.append(operator)
-		if operand is None: tokids.append(operand)
-		elif isinstance(operand, str) and OPR[operator][FORM]==KEY:
-			iid = allaids.get(operand.lstrip('-'),0)*(-1 if operand.startswith('-') else 1)
-			if iid == 0: raise Exception(f"identify error {operand}")
-			tokids.append(iid)
-		else: tokids.append(operand)
+# Postgres sequence for new key IDs
+def idseq() -> str:
+	return DB['table_name']+'_aid_seq'
 
-	return tokids
+
+# Create the ID sequence if missing and move it past every ID in use, or past floor
+def seqsync(floor: int = 0) -> int:
+	insert(f"CREATE SEQUENCE IF NOT EXISTS {idseq()} AS BIGINT START WITH {I['cor']+1}")
+	res = select(f"SELECT setval('{idseq()}', GREATEST((SELECT COALESCE(MAX(aid),0) FROM {DB['table_name']}), {I['cor']}, %s, (SELECT last_value FROM {idseq()})))", [int(floor)])
+	return int(res[0][0])
+
+
+# Input: name rows about to be written
+# Output: the highest ID that this process never saw the sequence reach, or 0
+# nextval() would later hand out an explicit ID past the sequence, so claimkeys() rejects those
+def seqpast(namerows: list) -> int:
+	kid = max(int(row[1]) for row in namerows)
+	with IDS_LOCK: return kid if kid > IDS['top'] else 0
+
+
+# Input: an ID seqpast() found, the sequence's last value
+def seqcheck(kid: int, last: int):
+	if kid > last: raise Exception(f"Id number {kid} is past the ID sequence, run: python3 ./memelang.py seqsync {kid}")
 
 
-def keyify(tokens: list, gids: list[int] = []) -> list:
+# Output: an unused ID
+# Reserves DB['id_block'] IDs per sequence round-trip, so concurrent writers never collide
+def newid() -> int:
+	with IDS_LOCK:
+		if IDS['pid'] != os.getpid(): IDS['pid'], IDS['free'] = os.getpid(), [] # Forked children reserve their own
+		if not IDS['free']:
+			block = DB.get('id_block', 1000)
+			try: rows = select(f"SELECT nextval('{idseq()}') FROM generate_series(1, %s)", [block])
+			except psycopg2.errors.UndefinedTable:
+				seqsync()
+				rows = select(f"SELECT nextval('{idseq()}') FROM generate_series(1, %s)", [block])
+			IDS['free'] = sorted((int(row[0]) for row in rows), reverse=True)
+			IDS['top'] = max(IDS['top'], IDS['free'][0])
+		return IDS['free'].pop()
+
+
+# Output: endless iterator of newid()
+def newids():
+	while True: yield newid()
+
+
+# Input: tokens with key strings [..., I['['], 'john_adams', ...]
+# Output: tokens with ID numbers [..., I['['], 123, ...]
+# fset['keysql'] skips the DB and leaves uncached keys as strings for querify()
+# found is {key: id} already looked up, such as by akeyids()
+def identify(tokens: list, gids: list[int] = [], fset={}, found: dict = None) -> list:
 	if not gids: gids = [GID]
-	allstrs=K
-	for gid in gids:
-		if not AID.get(gid): AID[gid]={}
-		for q, a in AID[gid].items(): allstrs.setdefault(a, q)
 
 	tlen = len(tokens)
 	if not tlen: return tokens
 
-	lookups={}
-	tokeys=[G, gids[-1]]
+	keys = [tokens[t+1].lstrip('-') for t in range(START, tlen, 2) if isinstance(tokens[t+1], str) and OPR[tokens[t]][FORM]==KEY]
+	allaids = keyids(keys, gids, not fset.get('keysql')) if found is None else found
 
-	for t in range(START, tlen, 2):
-		operator, operand = tokens[t], tokens[t+1]
-		if operand is None: continue
+	# Copy once, then swap only the key operands
+	tokids = list(tokens)
+	tokids[0], tokids[1] = G, gids[-1]
+	for t in range(START+1, tlen, 2):
+		operand = tokids[t]
+		if isinstance(operand, str) and OPR[tokids[t-1]][FORM]==KEY:
+			iid = allaids.get(operand.lstrip('-'),0)*(-1 if operand.startswith('-') else 1)
+			if iid != 0: tokids[t] = iid
+			elif not fset.get('keysql'): raise Exception(f"identify error {operand}")
 
-		elif isinstance(operand, int) and OPR[operator][FORM]==KEY:
-			operand=abs(operand)
-			if not allstrs.get(operand): lookups[operand]=1
+	return tokids
 
-	if lookups:
-		rows=selectin({'aid':lookups.keys(), 'rid':[I['nam']], 'bid':[I['key']], 'gid':gids}, DB['table_name'])
-		for row in rows: AID[int(row[0])][row[4]] = int(row[1])
 
-		# must keep gid order
-		for gid in gids:
-			for q, a in AID[gid].items(): allstrs.setdefault(a, q)
+# Input: tokens with ID numbers, {id: key} already looked up such as by aidkeys()
+# Output: tokens with key strings
+# lookup=False resolves IDs without the DB, such as operators left by keysql SQL
+def keyify(tokens: list, gids: list[int] = [], found: dict = None, lookup: bool = True) -> list:
+	if not gids: gids = [GID]
 
-	for t in range(START, tlen, 2):
-		operator, operand = tokens[t], tokens[t+1]
-		tokeys.append(operator)
-		if operand is None: tokeys.append(operand)
-		elif isinstance(operand, int) and OPR[operator][FORM]==KEY:
-			sign=''
-			if operand<0:
-				sign='-'
-				operand*=-1
-			tokeys.append(sign+allstrs[operand])
-		else: tokeys.append(operand)
+	tlen = len(tokens)
+	if not tlen: return tokens
+
+	iids = [abs(tokens[t+1]) for t in range(START, tlen, 2) if isinstance(tokens[t+1], int) and OPR[tokens[t]][FORM]==KEY]
+	allstrs = idkeys(iids, gids, lookup) if found is None else found
+
+	# Copy once, then swap only the ID operands
+	tokeys = list(tokens)
+	tokeys[0], tokeys[1] = G, gids[-1]
+	for t in range(START+1, tlen, 2):
+		operand = tokeys[t]
+		if isinstance(operand, int) and OPR[tokeys[t-1]][FORM]==KEY:
+			tokeys[t] = '-'+allstrs[-operand] if operand<0 else allstrs[operand]
 
 	return tokeys
 
 
 # Run decode() and identify()
-def idecode(memestr: str, gids: list[int] = []) -> list:
-	return identify(decode(memestr), gids)
+def idecode(memestr: str, gids: list[int] = [], fset={}) -> list:
+	return identify(decode(memestr), gids, fset)
 
 
 # Run keyify() and encode()
@@ -405,9 +1027,26 @@ def keyencode(tokens: list, gids: list[int] = []) -> str:
 #                         MEMELANG -> SQL QUERIES
 ###############################################################################
 
-# Input: tokens
-# Output: SELECT string, FROM string, WHERE string, and depth int
-def selectify(tokens: list, gids: list[int] = [], fset={}) -> tuple[str, list]:
+# SQL subselect for the ID of a key string passed as %s
+# Earlier gids win, as in keyids()
+def keyidsql(gids: list[int]) -> str:
+	gidlist = ','.join(str(int(gid)) for gid in gids)
+	order = '' if len(gids)==1 else f" ORDER BY array_position(ARRAY[{gidlist}]::BIGINT[], n.gid)"
+	return f"(SELECT n.aid FROM {DB['table_name']} n WHERE n.gid IN ({gidlist}) AND n.rid={I['nam']} AND n.bid={I['key']} AND n.qnt=%s{order} LIMIT 1)"
+
+
+# SQL expression for the key string of an ID column
+# Falls back to the ID text so keyify() can still resolve operators and strays
+def idkeysql(col: str, gids: list[int]) -> str:
+	gidlist = ','.join(str(int(gid)) for gid in gids)
+	order = '' if len(gids)==1 else f" ORDER BY array_position(ARRAY[{gidlist}]::BIGINT[], n.gid)"
+	return f"COALESCE((SELECT n.qnt::text FROM {DB['table_name']} n WHERE n.gid IN ({gidlist}) AND n.aid={col} AND n.rid={I['nam']} AND n.bid={I['key']}{order} LIMIT 1), {col}::text)"
+
+
+# Input: tokens of one clause, or of a statement with the clause's bounds from clausify()
+# Output: joins [{'inv': bool, 'sel': {func: bool}, 'whr': {'gid': gids, C: operator, func: operand}}, ...]
+# One join per chained [R, or ]B after ]B
+def joinify(tokens: list, gids: list[int] = [], beg: int = 0, end: int = None) -> list:
 	if not gids: gids = [GID]
 
 	joins=[{
@@ -416,13 +1055,12 @@ def selectify(tokens: list, gids: list[int] = [], fset={}) -> tuple[str, list]:
 		'whr' : {'gid': gids, C: I['=.']}
 	}]
 
-	olen=len(tokens)
-	for o in range(0, olen, 2):
+	for o in range(beg, len(tokens) if end is None else end, 2):
 		operator, operand = tokens[o], tokens[o+1]
-		func, form = OPR[operator][FUNC], OPR[operator][FORM]
+		func = OPR[operator][FUNC]
 
 		# Chained [R[R or ]B]B or [R][R
-		if o>2 and (func == R or (func == B and OPR[tokens[o-2]][FUNC] == B)):
+		if o-beg>2 and (func == R or (func == B and OPR[tokens[o-2]][FUNC] == B)):
 			joins.append({
 				'inv' : False,
 				'sel' : {},
@@ -431,7 +1069,9 @@ def selectify(tokens: list, gids: list[int] = [], fset={}) -> tuple[str, list]:
 
 		if func in (A,R,B):
 			if isinstance(operand, int) and operand<=0: joins[-1]['inv']=True
-			if operand is not None: joins[-1]['whr'][func]=abs(operand)
+			elif isinstance(operand, str) and operand.startswith('-'): joins[-1]['inv']=True
+			if isinstance(operand, str): joins[-1]['whr'][func]=operand.lstrip('-')
+			elif operand is not None: joins[-1]['whr'][func]=abs(operand)
 			joins[-1]['sel'][func]=True
 
 		elif func == Q:
@@ -442,14 +1082,30 @@ def selectify(tokens: list, gids: list[int] = [], fset={}) -> tuple[str, list]:
 	joins[-1]['sel'][B]=True
 	joins[-1]['sel'][Q]=True
 
+	return joins
+
+
+# Input: tokens
+# Output: SELECT string, FROM string, WHERE string, and depth int
+# Runs of joins along a built DB['paths'] chain read its path table, unless fset['path'] is False
+# beg and end bound the clause within tokens, as for joinify()
+def selectify(tokens: list, gids: list[int] = [], fset={}, beg: int = 0, end: int = None) -> tuple[str, list]:
+	if not gids: gids = [GID]
+
+	joins = joinify(tokens, gids, beg, end)
+	if len(gids)==1 and fset.get('path', True): joins = pathify(joins, pathrids(gids[0]))
 	froms, wheres, params = [], [], []
 	aselect, select, fbcol = '', '', ''
 	for m, join in enumerate(joins):
 		inv = join['inv']
-		tbl = DB['table_meme']
+		tbl = join['path'][0] if join.get('path') else DB['table_meme']
 		acol = 'bid' if inv else 'aid'
 		bcol = 'aid' if inv else 'bid'
 		rcol = 'rid*-1' if inv else 'rid'
+		akey, rkey, bkey = f"m{m}.{acol}", f"m{m}.{rcol}", f"m{m}.{bcol}"
+		if fset.get('keysql'):
+			akey, bkey = idkeysql(akey, gids), idkeysql(bkey, gids)
+			rkey = ("'-' || " if inv else '') + idkeysql(f"m{m}.rid", gids)
 		lbcol = fbcol
 		fbcol = bcol
 		qpre = ''
@@ -466,24 +1122,29 @@ def selectify(tokens: list, gids: list[int] = [], fset={}) -> tuple[str, list]:
 		if m==0: 
 			froms.append(f" FROM {tbl} m{m}")
 			aselect=f"m{m}.{acol} as a0"
-			select=f"concat_ws(' ', ';', m{m}.{acol}"
+			select=f"concat_ws(' ', ';', {akey}"
 		# JOIN
 		else: 
 			froms.append(f" JOIN {tbl} m{m} ON m{m-1}.{lbcol}=m{m}.{acol}")
 
 		# SELECT rid, bid, qnt
-		select+=f", {I['[']}, m{m}.{rcol}"
-		if join['sel'].get(B): select+=f", {I[']']}, m{m}.{bcol}"
+		if join.get('path'): select+=''.join(f", {I['[']}, " + (idkeysql(str(rid), gids) if fset.get('keysql') else str(rid)) for rid in join['path'][1])
+		else: select+=f", {I['[']}, {rkey}"
+		if join['sel'].get(B): select+=f", {I[']']}, {bkey}"
 		if join['sel'].get(Q): select+=f", COALESCE('{join['whr'][C]} {qpre}' || m{m}.qnt::text)"
 
-		# WHERE gid
+		# WHERE gid, inlined so the planner prunes partitions
 		if len(join['whr']['gid'])==1: wheres.append(f"m{m}.gid={int(join['whr']['gid'][0])}")
 		else: wheres.append(f"m{m}.gid IN ("+','.join(str(int(gid)) for gid in join['whr']['gid'])+")")
 
 		# WHERE aid, rid, bid, qnt
 		for xfunc, xcpr, xcol in ((A,'=',acol),(R,'=','rid'),(B,'=',bcol),(Q,cpr,'qnt')): # harcode rid
 			if join['whr'].get(xfunc):
-				wheres.append(f"m{m}.{xcol}{xcpr}%s")
+				if xfunc!=Q and isinstance(join['whr'][xfunc], str): wheres.append(f"m{m}.{xcol}{xcpr}" + keyidsql(gids))
+				elif fset.get('opt') and xcpr==' LIKE ' and join['whr'][xfunc]=='%':
+					wheres.append(f"m{m}.qnt IS NOT NULL") # Same rows as LIKE '%', without the pattern
+					continue
+				else: wheres.append(f"m{m}.{xcol}{xcpr}%s")
 				params.append(join['whr'][xfunc])
 
 
@@ -494,57 +1155,171 @@ def selectify(tokens: list, gids: list[int] = [], fset={}) -> tuple[str, list]:
 	), params
 
 
+# Input: tokens, statement bounds from nxt()
+# Output: {group: [[beg, end], ...]} of true clauses, then [[beg, end], ...] of =f and of =g clauses
+# Space-separated clauses are their own group, clauses ending in |N share group N
+def clausify(tokens: list, beg: int, end: int) -> tuple[dict, list, list]:
+	trues, nots, gets = {}, [], []
+	skip = False
+
+	for o in range(beg, end, 2): # Split by ' '
+		if OPR[tokens[o]][FUNC] == A and tokens[o+1] == I['qry']:
+			skip=True
+
+		elif o==end-2 or OPR[tokens[o+2]][FUNC]==A:
+			if tokens[o] == I['=f']: nots.append([beg, o+2]) # False
+			elif tokens[o] == I['=g']: gets.append([beg, o+2]) # Get
+			elif not skip: # True or Quantity
+				gnum = tokens[o+1] if tokens[o] == I['|'] else 1000+o
+				if not trues.get(gnum): trues[gnum]=[]
+				trues[gnum].append([beg, o+2])
+
+			skip=False
+			beg=o+2
+
+	return trues, nots, gets
+
+
+# Meme counts per graph for grouporder(), as {gid: (load time, stats)}, reloaded after DB['stats_ttl'] seconds
+STATS = {}
+STATS_BID_MIN = 8 # bids with fewer memes are not counted one by one
+
+
+# Input: graph ID, wait to load missing or stale stats here instead of in the background
+# Output: {'rows', 'aids' distinct, 'rid': {rid: memes}, 'bid': {bid: memes},
+# 'qnt': {(rid, bid): (memes, distinct qnt, min qnt, max qnt)}}, or None until the first load finishes
+def graphstats(gid: int, wait: bool = False) -> dict:
+	return cacheload(STATS, gid, statsload, DB.get('stats_ttl', 300), wait)
+
+
+# Input: graph ID
+# Output: graphstats() counts, read now with four aggregates over the graph
+def statsload(gid: int) -> dict:
+	meme_table = DB['table_meme']
+	rows, aids = select(f"SELECT COUNT(*), COUNT(DISTINCT aid) FROM {meme_table} WHERE gid=%s", [gid])[0]
+	return {
+		'rows': int(rows),
+		'aids': int(aids) or 1,
+		'rid': {int(rid): int(cnt) for rid, cnt in select(f"SELECT rid, COUNT(*) FROM {meme_table} WHERE gid=%s GROUP BY rid", [gid])},
+		'bid': {int(bid): int(cnt) for bid, cnt in select(f"SELECT bid, COUNT(*) FROM {meme_table} WHERE gid=%s GROUP BY bid HAVING COUNT(*)>=%s", [gid, STATS_BID_MIN])},
+		'qnt': {(int(row[0]), int(row[1])): (int(row[2]), int(row[3]), float(row[4]), float(row[5])) for row in select(f"SELECT rid, bid, COUNT(*), COUNT(DISTINCT qnt), MIN(qnt), MAX(qnt) FROM {meme_table} WHERE gid=%s AND qnt IS NOT NULL GROUP BY rid, bid HAVING COUNT(*)>=%s", [gid, STATS_BID_MIN])},
+	}
+
+
+# Input: join from joinify() with a quantity, graphstats() of each gid
+# Output: estimated rows passing the comparison, interpolated over the (rid, bid) range
+def qntcost(join: dict, stats: list) -> float:
+	whr, est = join['whr'], 0.0
+	for st in stats:
+		qst = None if join['inv'] or 'qnt' not in st else st['qnt'].get((whr.get(R), whr.get(B)))
+		if not qst:
+			est += st['rows']
+			continue
+		cnt, distinct, low, high = qst
+		x, span = whr[Q], (high-low) or 1.0
+		if whr[C]==I['=.']: est += cnt/distinct
+		elif whr[C] in (I['<'], I['<=']): est += cnt*min(1.0, max(0.0, (x-low)/span))
+		elif whr[C] in (I['>'], I['>=']): est += cnt*min(1.0, max(0.0, (high-x)/span))
+		else: est += cnt
+	return est
+
+
+# Input: tokens, graphstats() of each gid, bounds of one clause
+# Output: estimated rows of its most selective join
+def clausecost(tokens: list, gids: list[int], stats: list, beg: int = 0, end: int = None) -> float:
+	total = sum(st['rows'] for st in stats) or 1
+	peraid = total/sum(st['aids'] for st in stats)
+
+	best = total
+	for join in joinify(tokens, gids, beg, end):
+		whr, inv = join['whr'], join['inv']
+		if whr[C]==I['=$']: return 1.0
+		est = total
+		for func, col in ((A, 'bid' if inv else 'aid'), (B, 'aid' if inv else 'bid'), (R, 'rid')):
+			val = whr.get(func)
+			if not val or isinstance(val, str): continue # unknown until SQL resolves it
+			if col=='aid': est = min(est, peraid)
+			else: est = min(est, sum(st[col].get(val, 0 if col=='rid' else STATS_BID_MIN) for st in stats))
+		if whr.get(Q): est = min(est, qntcost(join, stats))
+		best = min(best, est)
+	return best
+
+
+# Input: tokens
+# Output: per statement, the order to run its true groups in (most selective first), or None to keep them
+# Groups only narrow each other's A when every clause's A is its first join's aid,
+# so statements with bare A clauses or inverse first joins keep their order
+# stats defaults to graphstats() of each gid, and groups keep their order until those first load
+def grouporder(tokens: list, gids: list[int] = [], stats: list = None) -> tuple:
+	if not gids: gids = [GID]
+	if not DB.get('join_order', True): return ()
+	order = []
+	end = START
+	while (end := nxt(tokens, (beg := end)))>0:
+		trues = list(clausify(tokens, beg, end)[0].values())
+		clauses = [clause for group in trues for clause in group]
+		if len(trues)<2 or any(end1-beg1==2 or joinify(tokens, gids, beg1, end1)[0]['inv'] for beg1, end1 in clauses):
+			order.append(None)
+			continue
+		if stats is None: stats = [graphstats(gid) for gid in gids]
+		if not all(stats): # first load still running
+			order.append(None)
+			continue
+		costs = [sum(clausecost(tokens, gids, stats, beg1, end1) for beg1, end1 in group) for group in trues]
+
+		# Estimates are rough, so only anchor on a group far more selective than the first
+		anchor = min(range(len(trues)), key=lambda g: costs[g])
+		if costs[anchor]*4 > costs[0]: order.append(None)
+		else: order.append((anchor,) + tuple(g for g in range(len(trues)) if g != anchor))
+	return tuple(order)
+
+
 # Input: Memelang query string
 # Output: SQL query string
-def querify(tokens: list, gids: list[int] = []) -> tuple[str, list]:
-
-	ctes, selects, params = [], [], []
+# fset['keysql'] resolves key strings in SQL and returns keys in arbq
+# fset['rows'] returns one arbq row per statement instead of one string_agg row
+# fset['count'] returns the number of distinct statements instead
+# fset['order'] is grouporder() of the tokens, computed here when missing
+# fset['opt'] semi-joins with EXISTS instead of IN, and only dedups in the final UNION
+def querify(tokens: list, gids: list[int] = [], fset={}) -> tuple[str, list]:
+
+	ctes, selects, params, sel_params = [], [], [], []
 	cte_beg, cte_end = 0, 0
+	order = fset['order'] if 'order' in fset else grouporder(tokens, gids)
+	opt = fset.get('opt')
 
+	# Rows of alias whose col is an a0 of CTE z
+	def inz(z, alias, col, neg=''): 
+		if opt: return f"{neg}EXISTS (SELECT 1 FROM {z} z WHERE z.a0={alias}.{col})"
+		return f"{alias}.{col} {neg}IN (SELECT a0 FROM {z})"
+
+	stmt = -1
 	beg = 0
 	end = START
 	while (end := nxt(tokens, (beg := end)))>0: # Split by ;
 
-		trues={}
-		skip = False
+		stmt += 1
+		trues, nots, gets = clausify(tokens, beg, end)
+		if order and order[stmt]: trues = {gnum: trues[gnum] for gnum in (list(trues)[g] for g in order[stmt])}
 		cte_beg = cte_end
 		not_params = []
 		not_where = ''
-		ret_selects = []
-
-		for o in range(beg, end, 2): # Split by ' '
-			if OPR[tokens[o]][FUNC] == A and tokens[o+1] == I['qry']:
-				skip=True
 
-			elif o==end-2 or OPR[tokens[o+2]][FUNC]==A:
-				if tokens[o] == I['=f']: # False
-					qry_select, qry_params = selectify(tokens[beg:o+2], gids, {'aidselect':True})
-					not_where += f" AND m0.aid NOT IN ({qry_select})"
-					not_params.extend(qry_params)
-
-				elif tokens[o] == I['=g']: # Get
-					qry_select, qry_params = selectify(tokens[beg:o+2], gids)
-					ret_selects.append(f"{qry_select} AND a0 IN (SELECT a0 FROM ZLAST)")
-					params.extend(qry_params)
-
-				elif not skip: # True or Quantity
-					gnum = tokens[o+1] if tokens[o] == I['|'] else 1000+o
-					if not trues.get(gnum): trues[gnum]=[]
-					trues[gnum].append([beg, o+2])
-
-				skip=False
-				beg=o+2
+		for beg1, end1 in nots:
+			qry_select, qry_params = selectify(tokens, gids, {'aidselect':True, 'opt':opt}, beg1, end1)
+			not_where += ' AND ' + inz(f"({qry_select})", 'm0', 'aid', 'NOT ')
+			not_params.extend(qry_params)
 
 		for gnum in trues:
 			or_selects = []
 			for beg1, end1 in trues[gnum]:
-				qry_select, qry_params = selectify(tokens[beg1:end1], gids)
+				qry_select, qry_params = selectify(tokens, gids, fset, beg1, end1)
 
 				if cte_end==cte_beg:
 					qry_select += not_where
 					qry_params.extend(not_params)
 
-				else: qry_select+=f" AND m0.aid IN (SELECT a0 FROM z{cte_end})"
+				else: qry_select+=' AND ' + inz(f"z{cte_end}", 'm0', 'aid')
 
 				or_selects.append(qry_select)
 				params.extend(qry_params)
@@ -552,42 +1327,296 @@ def querify(tokens: list, gids: list[int] = []) -> tuple[str, list]:
 				# FIX LATER
 				# Also get inverse for A query
 				if (end1-beg1) == 2 and OPR[tokens[beg1]][FUNC] == A and tokens[beg1+1] is not None:
-					qry_select, qry_params = selectify([I[';'], tokens[beg1+1]*-1], gids)
+					aid = tokens[beg1+1]
+					if isinstance(aid, str): inv = aid[1:] if aid.startswith('-') else '-'+aid
+					else: inv = aid*-1
+					qry_select, qry_params = selectify([I[';'], inv], gids, fset)
 					or_selects.append(qry_select)
 					params.extend(qry_params)
-					qry_select, qry_params = selectify([I[';'], tokens[beg1+1], I['=$'], '%'], gids)
+					qry_select, qry_params = selectify([I[';'], aid, I['=$'], '%'], gids, fset)
 					or_selects.append(qry_select)
 					params.extend(qry_params)
 
 			cte_end += 1
-			ctes.append(f"z{cte_end} AS ({' UNION '.join(or_selects)})")
+			ctes.append(f"z{cte_end} AS ({(' UNION ALL ' if opt else ' UNION ').join(or_selects)})")
+
+		if cte_end==cte_beg: continue
+
+		# =g clauses only where A is in the last group
+		for beg1, end1 in gets:
+			qry_select, qry_params = selectify(tokens, gids, fset, beg1, end1)
+			selects.append(f"SELECT arbq FROM ({qry_select}) g WHERE " + inz(f"z{cte_end}", 'g', 'a0'))
+			sel_params.extend(qry_params)
 
 		for cte_cnt in range(cte_beg, cte_end):
-			ret_selects.append(f"SELECT arbq FROM z{cte_cnt+1}" + ('' if cte_cnt+1 == cte_end else f" WHERE a0 IN (SELECT a0 FROM ZLAST)"))
+			selects.append(f"SELECT arbq FROM z{cte_cnt+1}" + ('' if cte_cnt+1 == cte_end else ' WHERE ' + inz(f"z{cte_end}", f"z{cte_cnt+1}", 'a0')))
 
-		selects.extend([ret_select.replace('ZLAST', f"z{cte_end}") for ret_select in ret_selects])
+	if fset.get('rows'): sql = 'WITH ' + ', '.join(ctes) + ' ' + ' UNION '.join(selects)
+	elif fset.get('count'): sql = 'WITH ' + ', '.join(ctes) + ' SELECT COUNT(*) FROM (' + ' UNION '.join(selects) + ')'
+	else: sql = 'WITH ' + ', '.join(ctes) + " SELECT string_agg(arbq, ' ') AS arbq FROM (" + ' UNION '.join(selects) + ')'
 
-	sql = 'WITH ' + ', '.join(ctes) + " SELECT string_agg(arbq, ' ') AS arbq FROM (" + ' UNION '.join(selects) + ')'
+	return sql, params + sel_params
 
-	return sql, params
 
+###############################################################################
+#                            QUERY PLAN CACHE
+###############################################################################
+
+# Probe values for plan slots, far above any real ID yet exact as a float
+PROBE = 1<<48
+
+# Cached querify() output by query shape
+PLANS = OrderedDict()
+PLANS_LOCK = threading.Lock()
+PLAN_IDS = itertools.count(1)
+PLAN_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+# Input: tokens
+# Output: shape tuple and list of operand slot positions
+# Operands that change the SQL text (None, sign, falsy, operator IDs, |groups, path chain rids) stay in the shape
+def shapify(tokens: list, rids: frozenset = frozenset()) -> tuple[tuple, list]:
+	shape, slots = [], []
+	for t in range(START, len(tokens), 2):
+		operator, operand = tokens[t], tokens[t+1]
+		form = OPR[operator][FORM]
+		shape.append(operator)
+		if operand is None or form in (NULL, INTEGER) or not operand: shape.append(operand)
+		elif form == KEY and isinstance(operand, int):
+			if abs(operand) in K or (OPR[operator][FUNC]==R and operand in rids): shape.append(operand)
+			else:
+				shape.append('-' if operand<0 else '+')
+				slots.append(t+1)
+		elif form == KEY:
+			shape.append('-$' if operand.startswith('-') else '+$')
+			slots.append(t+1)
+		else:
+			shape.append(form)
+			slots.append(t+1)
+	return tuple(shape), slots
 
-# Input: Memelang string
-# Saves to DB
-# Output: Memelang string
-def put (memestr: str, gids: list[int] = []) -> str:
-	meme_table=DB['table_meme']
-	name_table=DB['table_name']
 
+# Input: tokens
+# Output: querify() SQL, params and a plan name, cached by shape
+# Slots are swapped for probe values, so each param maps back to a token position
+def planify(tokens: list, gids: list[int] = [], fset={}) -> tuple[str, list, str]:
 	if not gids: gids = [GID]
-	gid=gids[-1]
-	if gid not in AID: AID[gid]={}
+	if not DB.get('plan_cache', 256):
+		sql, params = querify(tokens, gids, fset)
+		return sql, params, None
+
+	fset = {**fset, 'order': grouporder(tokens, gids)} # from the real IDs, not the probes
+	rids = frozenset(rid for table, path in pathrids(gids[0]) for rid in path) if len(gids)==1 and fset.get('path', True) else frozenset()
+	shape, slots = shapify(tokens, rids) # selectify() must see the real rids to match path chains
+	pkey = (shape, tuple(gids), tuple(sorted(fset.items())))
+
+	with PLANS_LOCK:
+		plan = PLANS.get(pkey)
+		if plan:
+			PLANS.move_to_end(pkey)
+			PLAN_STATS['hits'] += 1
+		else: PLAN_STATS['misses'] += 1
+
+	if not plan:
+		probe, probes = list(tokens), {}
+		for t in slots:
+			operand, form = tokens[t], OPR[tokens[t-1]][FORM]
+			probes[PROBE+t] = probes[f"\x00{t}"] = t
+			if form == KEY and isinstance(operand, int): probe[t] = (PROBE+t)*(-1 if operand<0 else 1)
+			elif form == KEY: probe[t] = ('-' if operand.startswith('-') else '') + f"\x00{t}"
+			elif form == DECIMAL: probe[t] = float(PROBE+t)
+			else: probe[t] = f"\x00{t}"
+
+		sql, pparams = querify(probe, gids, fset)
+
+		# [token position, None] or [None, constant]
+		spec = [[probes[param], None] if param in probes else [None, param] for param in pparams]
+		plan = (sql, spec, f"memeplan{next(PLAN_IDS)}")
+
+		with PLANS_LOCK:
+			PLANS[pkey] = plan
+			while len(PLANS) > DB.get('plan_cache', 256):
+				PLANS.popitem(last=False)
+				PLAN_STATS['evictions'] += 1
+
+	sql, spec, name = plan
+	params = []
+	for t, const in spec:
+		if t is None: params.append(const)
+		elif isinstance(tokens[t], str) and OPR[tokens[t-1]][FORM] == KEY: params.append(tokens[t].lstrip('-'))
+		elif OPR[tokens[t-1]][FORM] == KEY: params.append(abs(tokens[t]))
+		else: params.append(tokens[t])
+	return sql, params, name
 
-	tokens = decode(memestr)
+
+# Output: {'size', 'hits', 'misses', 'evictions', 'hitrate'}
+def planstats() -> dict:
+	with PLANS_LOCK:
+		stats = {'size': len(PLANS), **PLAN_STATS}
+	lookups = stats['hits'] + stats['misses']
+	stats['hitrate'] = stats['hits']/lookups if lookups else 0.0
+	return stats
+
+
+###############################################################################
+#                              RESULT CACHE
+###############################################################################
+
+# Cached query() and count() results by (kind, decoded tokens, gids)
+# Each entry keeps the write generations of its graphs, so any write to them makes it miss
+RESULTS = OrderedDict()
+RESULTS_LOCK = threading.Lock()
+RESULT_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+# Write generation per graph, bumped by resultbump()
+GENS = {}
+
+# SQLite connection to DB['result_store'], shared by this process's threads
+STORE = {'pid': 0, 'conn': None}
+STORE_LOCK = threading.Lock()
+
+
+# Output: connection to the shared result store, or None for the in-process cache
+# Put DB['result_store'] on /dev/shm to keep it in memory
+def resultstore():
+	if not DB.get('result_store'): return None
+	if STORE['pid'] != os.getpid():
+		conn = sqlite3.connect(DB['result_store'], timeout=10, isolation_level=None, check_same_thread=False)
+		conn.execute('PRAGMA journal_mode=WAL')
+		conn.execute('CREATE TABLE IF NOT EXISTS results (k TEXT PRIMARY KEY, v TEXT, expires REAL, gens TEXT, used REAL)')
+		conn.execute('CREATE TABLE IF NOT EXISTS gens (gid INTEGER PRIMARY KEY, gen INTEGER)')
+		STORE['pid'], STORE['conn'] = os.getpid(), conn
+	return STORE['conn']
+
+
+# Input: cache key, gids
+# Output: (cached value or None, current generations to hand to resultput())
+def resultget(key: tuple, gids: list[int]) -> tuple:
+	if not DB.get('result_cache'): return None, None
+	now = time.time()
+
+	store = resultstore()
+	if store:
+		skey = json.dumps(key)
+		with STORE_LOCK:
+			gens = dict(store.execute(f"SELECT gid, gen FROM gens WHERE gid IN ({','.join('?'*len(gids))})", gids).fetchall())
+			gens = json.dumps([gens.get(gid, 0) for gid in gids])
+			row = store.execute('SELECT v, expires, gens FROM results WHERE k=?', [skey]).fetchone()
+			if row and row[2]==gens and (not row[1] or row[1]>now):
+				store.execute('UPDATE results SET used=? WHERE k=?', [now, skey])
+				RESULT_STATS['hits'] += 1
+				return json.loads(row[0]), gens
+			RESULT_STATS['misses'] += 1
+			return None, gens
+
+	with RESULTS_LOCK:
+		gens = tuple(GENS.get(gid, 0) for gid in gids)
+		entry = RESULTS.get(key)
+		if entry and entry[2]==gens and (not entry[1] or entry[1]>now):
+			RESULTS.move_to_end(key)
+			RESULT_STATS['hits'] += 1
+			return entry[0], gens
+		if entry: del RESULTS[key]
+		RESULT_STATS['misses'] += 1
+		return None, gens
+
+
+# Input: cache key, generations from resultget() before the result was made, result
+# Output: the result
+def resultput(key: tuple, gens, value):
+	if gens is None: return value
+	size, ttl = DB.get('result_cache'), DB.get('result_ttl', 0)
+	expires = time.time()+ttl if ttl else 0
+
+	store = resultstore()
+	if store:
+		with STORE_LOCK:
+			store.execute('INSERT OR REPLACE INTO results VALUES (?,?,?,?,?)', [json.dumps(key), json.dumps(value), expires, gens, time.time()])
+			over = store.execute('SELECT COUNT(*) FROM results').fetchone()[0] - size
+			if over>0:
+				store.execute('DELETE FROM results WHERE k IN (SELECT k FROM results ORDER BY used LIMIT ?)', [over])
+				RESULT_STATS['evictions'] += over
+		return value
+
+	with RESULTS_LOCK:
+		RESULTS[key] = (value, expires, gens)
+		RESULTS.move_to_end(key)
+		while len(RESULTS) > size:
+			RESULTS.popitem(last=False)
+			RESULT_STATS['evictions'] += 1
+	return value
+
+
+# Invalidate cached results of graphs just written to
+def resultbump(gids):
+	gids = set(int(gid) for gid in gids)
+	if not gids or not DB.get('result_cache'): return
+	store = resultstore()
+	if store:
+		with STORE_LOCK:
+			for gid in gids: store.execute('INSERT INTO gens VALUES (?,1) ON CONFLICT(gid) DO UPDATE SET gen=gen+1', [gid])
+		return
+	with RESULTS_LOCK:
+		for gid in gids: GENS[gid] = GENS.get(gid, 0)+1
+
+
+# Drop every cached result
+def resultclear():
+	store = resultstore()
+	if store:
+		with STORE_LOCK: store.execute('DELETE FROM results')
+	with RESULTS_LOCK: RESULTS.clear()
+
+
+# Output: {'size', 'hits', 'misses', 'evictions', 'hitrate'} for this process
+def resultstats() -> dict:
+	store = resultstore()
+	if store:
+		with STORE_LOCK: size = store.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+	else: size = len(RESULTS)
+	with RESULTS_LOCK: stats = {'size': size, **RESULT_STATS}
+	lookups = stats['hits'] + stats['misses']
+	stats['hitrate'] = stats['hits']/lookups if lookups else 0.0
+	return stats
+
+
+###############################################################################
+#                           MEMELANG READS & WRITES
+###############################################################################
+
+# Input: name rows for new keys of one graph
+# Commits them at once and caches the IDs that won
+# A concurrent writer may have claimed the same key first, so read them back
+def claimkeys(namerows: list):
+	gid = namerows[0][0]
+	if kid := seqpast(namerows): seqcheck(kid, int(select(f"SELECT last_value FROM {idseq()}")[0][0]))
+	insert(f"INSERT INTO {DB['table_name']} VALUES " + ','.join(['(%s,%s,%s,%s,%s)']*len(namerows)) + " ON CONFLICT DO NOTHING", [col for row in namerows for col in row])
+	cache = keycache(gid)
+	rows = selectin({'gid':[gid], 'rid':[I['nam']], 'bid':[I['key']], 'qnt':[row[4] for row in namerows]}, DB['table_name'])
+	claimcheck(namerows, rows)
+	for row in rows: cache.add(row[4], int(row[1]))
+	memesync(rows)
+
+
+# Input: name rows claimkeys() wrote, the key rows read back from their graph
+# Without partitions the name table's qnt index is unique across graphs, so a key
+# held by another graph is neither written nor read back
+def claimcheck(namerows: list, rows: list):
+	won = {row[4] for row in rows}
+	taken = [row[4] for row in namerows if row[4] not in won]
+	if taken: raise Exception(f"Key taken outside graph {namerows[0][0]}: {' '.join(taken)}")
+
+
+# Input: decoded tokens, iterator of unused IDs for new keys such as newids()
+# Output: identified tokens, name table rows, meme table rows, impl table rows
+# fset['claim'] writes new keys first through claimkeys() and returns no name rows
+# fset['cached'] checks new keys against a keycache() the caller already filled, skipping the DB
+def rowify(tokens: list, gids: list[int], ids, fset={}) -> tuple[list, list, list, list]:
+	gid=gids[-1]
+	cache=keycache(gid)
 	olen = len(tokens)
 
-	sqls = {meme_table:[], name_table:[]}
-	params = {meme_table:[], name_table:[]}
+	namerows, memerows, implrows = [], [], []
 
 	# NEW KEY NAMES
 
@@ -599,42 +1628,52 @@ def put (memestr: str, gids: list[int] = []) -> str:
 		form = OPR[tokens[o]][FORM]
 
 		if form == STRING: 
-			if o>=8 and tokfit(tokens[o-6:o+2], [A, False, R, I['nam'], B, I['key'], I['=$'], False]):
+			if o>=8 and tokfit(tokens, [A, False, R, I['nam'], B, I['key'], I['=$'], False], o-6):
 				newkeys[tokens[o+1].lower()] = tokens[o-5]
 
 		elif form == KEY and isinstance(operand, str):
-			iid = AID[gid].get(operand.lstrip('-'),0)*(-1 if operand.startswith('-') else 1)
+			key = operand.lstrip('-')
+			iid = (I.get(key) or cache.id(key) or 0)*(-1 if operand.startswith('-') else 1)
 			if iid != 0: tokens[o+1]=iid
 			else: 
-				quo = tokens[o+1].lstrip('-').lower()
+				quo = key.lower()
 				if not newkeys.get(quo): newkeys[quo] = 0.5
 
 	# Unique check keys
-	rows=selectin({'gid':[gid], 'rid':[I['nam']], 'bid':[I['key']], 'qnt':newkeys.keys()}, DB['table_name'])
+	if fset.get('cached'): rows = [[gid, cache.id(quo), I['nam'], I['key'], quo] for quo in newkeys if cache.id(quo) is not None]
+	else: rows=selectin({'gid':[gid], 'rid':[I['nam']], 'bid':[I['key']], 'qnt':newkeys.keys()}, DB['table_name'])
 	for row in rows:
 		quo=row[4]
 		if newkeys.get(quo):
-			if int(row[1]) == int(newkeys[quo]) or isinstance(newkeys[quo], float): newkeys.pop(quo, 0)
+			if int(row[1]) == int(newkeys[quo]) or isinstance(newkeys[quo], float):
+				cache.add(quo, int(row[1]))
+				newkeys.pop(quo, 0)
 			else: raise Exception(f"Duplicate key {quo} for new {newkeys[quo]} and old {row[1]}")
 
 	# Write new keys
-	aidmax = aggnum('aid', 'MAX', name_table) or I['cor']
+	# Their IDs reach keycache() only once the name rows commit, through claimkeys() or the caller
+	kids = {}
 	for quo in newkeys:
 
 		if re.search(r'[^a-z0-9_]', quo) or not re.search(r'[a-z]', quo):
 			raise Exception(f'Invalid key {quo}')
 
 		kid = int(newkeys[quo])
-		if not kid:
-			aidmax += 1
-			kid = aidmax
+		if not kid: kid = next(ids)
 		elif kid<=I['cor']: raise Exception(f'Invalid id number {kid}')
 
-		AID[gid][quo]=kid
-		sqls[name_table].append("(%s,%s,%s,%s,%s)")
-		params[name_table].extend([gid, kid, I['nam'], I['key'], quo])
+		kids[quo] = kid
+		namerows.append([gid, kid, I['nam'], I['key'], quo])
+
+	if fset.get('claim') and namerows:
+		claimkeys(namerows)
+		namerows, kids = [], {}
 
 	# Swap missing keys for new IDs
+	for o in range(START, olen, 2):
+		operand = tokens[o+1]
+		if isinstance(operand, str) and OPR[tokens[o]][FORM]==KEY and operand.lstrip('-') in kids:
+			tokens[o+1] = kids[operand.lstrip('-')]*(-1 if operand.startswith('-') else 1)
 	tokens=identify(tokens, gids)
 	
 	# NEW MEMES
@@ -643,8 +1682,13 @@ def put (memestr: str, gids: list[int] = []) -> str:
 	while (end := nxt(tokens, (beg := end)))>0:
 		if end-beg==0: continue
 
+		# [R]B >> [R]B
+		elif I['>>'] in tokens[beg:end:2]: # a short slice scans faster than a generator
+			implrows.append(implrow(tokens[beg:end], gid))
+			if not implrows[-1]: raise Exception('Could not put tokens: ' + keyencode(tokens[beg:end], [gid]))
+
 		# A[R]B ..
-		elif tokfit(tokens[beg:beg+6], [A, False, R, False, B, False]):
+		elif beg+6<=end and tokfit(tokens, [A, False, R, False, B, False], beg):
 
 			# Invert R
 			if tokens[beg+3]<0:
@@ -652,64 +1696,1487 @@ def put (memestr: str, gids: list[int] = []) -> str:
 				tokens[beg+1], tokens[beg+5] = tokens[beg+5], tokens[beg+1]
 
 			# A[R]B;
-			if end == beg+6:
-				params[meme_table].extend([gid, tokens[beg+1], tokens[beg+3], tokens[beg+5], None])
-				sqls[meme_table].append('(%s,%s,%s,%s,%s)')	
+			if end == beg+6: memerows.append([gid, tokens[beg+1], tokens[beg+3], tokens[beg+5], None])
 
 			# A[nam]B = "String"
 			elif tokens[beg+6] == I['=$']:
-				if tokens[beg+5]!=I['key']:
-					params[meme_table].extend([gid, tokens[beg+1], I['nam'], tokens[beg+5], tokens[beg+7]])
-					sqls[meme_table].append('(%s,%s,%s,%s,%s)')
+				if tokens[beg+5]!=I['key']: memerows.append([gid, tokens[beg+1], I['nam'], tokens[beg+5], tokens[beg+7]])
 
 			# A[R]B=Q and A[R]B=t
-			elif tokens[beg+6] in (I['=t'], I['=.']):
-				params[meme_table].extend([gid, tokens[beg+1], tokens[beg+3], tokens[beg+5], tokens[beg+7]])
-				sqls[meme_table].append('(%s,%s,%s,%s,%s)')
+			elif tokens[beg+6] in (I['=t'], I['=.']): memerows.append([gid, tokens[beg+1], tokens[beg+3], tokens[beg+5], tokens[beg+7]])
 
 			else: raise Exception('Could not put tokens: ' + keyencode(tokens[beg:end], [gid]))
 
-		# TO DO: WRITE TO IMPL TABLE
-
 		else: raise Exception('Could not put tokens: ' + keyencode(tokens[beg:end], [gid]))
 
-	for tbl in params:
-		if params[tbl]: insert(f"INSERT INTO {tbl} VALUES " + ','.join(sqls[tbl]) + " ON CONFLICT DO NOTHING", params[tbl])
+	return tokens, namerows, memerows, implrows
+
+
+# Input: Memelang string
+# Saves to DB
+# Output: Memelang string
+def put (memestr: str, gids: list[int] = []) -> str:
+	if not gids: gids = [GID]
+	gid=gids[-1]
+
+	with timing('decode'): tokens = decode(memestr)
+	with timing('rowify'): tokens, namerows, memerows, implrows = rowify(tokens, gids, newids(), {'claim': True}) # Concurrent put()s may race for new keys
+
+	# Only memes not already there go on to derive(), so re-putting one with another qnt implies nothing
+	if memerows: memerows = select(f"INSERT INTO {DB['table_meme']} VALUES " + ','.join(['(%s,%s,%s,%s,%s)']*len(memerows)) + " ON CONFLICT DO NOTHING RETURNING gid, aid, rid, bid, qnt", [col for row in memerows for col in row])
+	if namerows: insert(f"INSERT INTO {DB['table_name']} VALUES " + ','.join(['(%s,%s,%s,%s,%s)']*len(namerows)) + " ON CONFLICT DO NOTHING", [col for row in namerows for col in row])
+	with timing('derive'): memerows = derive(memerows, implrows)
+	memesync(namerows, memerows)
 
 	return keyencode(tokens, [gid])
 
 
+# Input: arbq text "; 123 2 456 3 789 9 1.5"
+# Output: tokens [G, gid, I[';'], 123, I['['], 456, ...]
+# Operands already returned as keys stay strings
+def tokenify(arbq: str, gids: list[int] = []) -> list:
+	if not gids: gids = [GID]
+	tokens=[G, gids[-1]]
+	for tok in arbq.split():
+		if tok==';': tokens.append(I[';'])
+		elif tok.startswith('"'): tokens.append(tok[1:])
+		elif '.' in tok: tokens.append(float(tok))
+		elif tok.lstrip('-').isdigit(): tokens.append(int(tok))
+		else: tokens.append(tok)
+	return tokens
+
+
 # Input: Memelang query string
 # Output: Memelang results string
-def query(memestr: str = None, gids: list[int] = []) -> str:
+# fset['keysql'] (default DB['key_sql']) resolves keys inside the one SQL query
+# Graphs in a MemGraph are answered from memory, unless fset['mem'] is False
+# Results are cached when DB['result_cache'] is set, unless fset['cache'] is False
+def query(memestr: str = None, gids: list[int] = [], fset={}) -> str:
 	if not gids: gids = [GID]
+	fset = {'keysql': DB.get('key_sql', False), 'opt': DB.get('sql_opt', False), **fset}
+	start = time.perf_counter()
 
-	tokens = idecode(memestr, gids)
-	sql, params = querify(tokens, gids)
-	res = select(sql, params)
+	with timing('decode'): tokens = decode(memestr)
+	key = ('query', tuple(tokens), tuple(gids))
+	cached, gens = resultget(key, gids) if fset.get('cache', True) else (None, None)
+	if cached is not None: return cached
 
-	if not res or not res[0] or not res[0][0]: return ''
+	graph = memgraph(gids) if fset.get('mem', True) else None
+	if graph: return resultput(key, gens, graph.query(memestr, gids))
 
-	tokens=[G, gids[-1]]
+	with timing('identify'): tokens = identify(tokens, gids, fset)
+	with timing('querify'): sql, params, name = planify(tokens, gids, fset)
+	res = select(sql, params, name if DB.get('plan_prepare') else None)
 
-	strtoks=res[0][0].split()
-	for tok in strtoks:
-		if tok==';': tokens.append(I[';'])
-		elif tok.startswith('"'): tokens.append(tok[1:])
-		elif '.' in tok: tokens.append(float(tok))
-		else: tokens.append(int(tok))
+	if not res or not res[0] or not res[0][0]: out = ''
+	else:
+		with timing('keyify'): out = keyencode(tokenify(res[0][0], gids), gids)
+
+	slowlog(memestr, sql, params, res, time.perf_counter()-start)
+	return resultput(key, gens, out)
+
+
+# Input: list of Memelang query strings
+# Output: list of Memelang results strings, in input order
+# Looks up the keys of every query at once, runs every query in one SQL statement
+# tagged by list index, then looks up the result IDs at once
+def query_many(memestrs: list, gids: list[int] = [], fset={}) -> list:
+	if not gids: gids = [GID]
+	fset = {'keysql': DB.get('key_sql', False), 'opt': DB.get('sql_opt', False), **fset}
+
+	results, todo = [None]*len(memestrs), []
+	graph = memgraph(gids) if fset.get('mem', True) else None
+	for n, memestr in enumerate(memestrs):
+		with timing('decode'): tokens = decode(memestr)
+		key = ('query', tuple(tokens), tuple(gids))
+		cached, gens = resultget(key, gids) if fset.get('cache', True) else (None, None)
+		if cached is not None: results[n] = cached
+		elif graph: results[n] = resultput(key, gens, graph.query(memestr, gids))
+		else: todo.append((n, tokens, key, gens))
+
+	if not todo: return results
 
-	return keyencode(tokens, gids)
+	with timing('identify'):
+		keys = [tokens[t+1].lstrip('-') for n, tokens, key, gens in todo for t in range(START, len(tokens), 2) if isinstance(tokens[t+1], str) and OPR[tokens[t]][FORM]==KEY]
+		found = keyids(keys, gids, not fset.get('keysql'))
+		todo = [(n, identify(tokens, gids, fset, found), key, gens) for n, tokens, key, gens in todo]
+
+	selects, params = [], []
+	with timing('querify'):
+		for n, tokens, key, gens in todo:
+			sql, qry_params, name = planify(tokens, gids, fset)
+			selects.append(f"SELECT {n} AS n, ({sql}) AS arbq")
+			params.extend(qry_params)
+	rows = {row[0]: row[1] for row in select(' UNION ALL '.join(selects), params)}
+
+	with timing('keyify'):
+		tokenses = {n: tokenify(rows[n], gids) for n, tokens, key, gens in todo if rows.get(n)}
+		iids = [abs(tokens[t+1]) for tokens in tokenses.values() for t in range(START, len(tokens), 2) if isinstance(tokens[t+1], int) and OPR[tokens[t]][FORM]==KEY]
+		found = idkeys(iids, gids)
+		for n, tokens, key, gens in todo:
+			results[n] = resultput(key, gens, encode(keyify(tokenses[n], gids, found)) if n in tokenses else '')
+
+	return results
+
+
+# Server-side cursor names for query_iter()
+CURSOR_IDS = itertools.count(1)
+
+
+# Input: Memelang query string
+# Output: generator of Memelang statement strings, or token lists with fset['tokens']
+# Streams rows from a server-side cursor fset['size'] (default DB['fetch_size']) at a time
+def query_iter(memestr: str, gids: list[int] = [], fset={}):
+	if not gids: gids = [GID]
+	fset = {'keysql': DB.get('key_sql', False), 'opt': DB.get('sql_opt', False), **fset}
+	size = fset.get('size') or DB.get('fetch_size', 1000)
+
+	graph = memgraph(gids) if fset.get('mem', True) else None
+	if graph:
+		tokens = graph.keyify(graph.tokens(memestr, gids), gids)
+		end = START
+		while (end := nxt(tokens, (beg := end)))>0:
+			yield tokens[:START] + tokens[beg:end] if fset.get('tokens') else encode(tokens[:START] + tokens[beg:end])
+		return
+
+	tokens = idecode(memestr, gids, fset)
+	# The SQL returns key strings, so no second connection is checked out for keys while the cursor holds this one
+	sql, params, name = planify(tokens, gids, {**fset, 'rows': True, 'keysql': True})
+
+	with pooled() as conn:
+		with conn.cursor(name=f"memeiter{next(CURSOR_IDS)}") as cursor:
+			cursor.itersize = size
+			cursor.execute(sql, params)
+			while rows := cursor.fetchmany(size):
+				tokens = keyify(tokenify(' '.join(row[0] for row in rows if row[0]), gids), gids, None, False)
+				end = START
+				while (end := nxt(tokens, (beg := end)))>0:
+					if fset.get('tokens'): yield tokens[:START] + tokens[beg:end]
+					else: yield encode(tokens[:START] + tokens[beg:end])
+
+
+# Input: fset of count()
+# Output: the fset for its planify(), without the flags planify() doesn't read
+# keysql only changes the keys returned, which a count never reads
+def countset(fset: dict) -> dict:
+	return {key: val for key, val in fset.items() if key not in ('cache', 'mem', 'keysql')}
 
 
 # Input: Memelang query string
 # Output: Integer count of resulting memes
-def count(memestr: str, gids: list[int] = []) -> int:
+# Counted in SQL, so no result rows leave the DB
+def count(memestr: str, gids: list[int] = [], fset={}) -> int:
+	if not gids: gids = [GID]
+	fset = {'keysql': DB.get('key_sql', False), 'opt': DB.get('sql_opt', False), **fset}
+	start = time.perf_counter()
+
+	with timing('decode'): tokens = decode(memestr)
+	key = ('count', tuple(tokens), tuple(gids))
+	cached, gens = resultget(key, gids) if fset.get('cache', True) else (None, None)
+	if cached is not None: return cached
+
+	graph = memgraph(gids) if fset.get('mem', True) else None
+	if graph: return resultput(key, gens, graph.count(memestr, gids))
+
+	with timing('identify'): tokens = identify(tokens, gids, fset)
+	with timing('querify'): sql, params, name = planify(tokens, gids, {**countset(fset), 'count': True})
+	res=select(sql, params, name if DB.get('plan_prepare') else None)
+	slowlog(memestr, sql, params, res, time.perf_counter()-start)
+	return resultput(key, gens, int(res[0][0]) if res and res[0] else 0)
+
+
+###############################################################################
+#                                IMPLICATIONS
+###############################################################################
+
+# A rule [R1]B1 >> [R2]B2 in the impl table gives A[R2]B2 to every A[R1]B1
+# Either side may end in =t, the left may compare its quantity, the right may set one
+# put() and the bulk loaders write what the rules imply into the meme table,
+# so queries read inferred memes as plain rows
+
+# Rules by graph, as (impl rows of the graph, {(rid1, bid1): [[cpr1, qnt1, rid2, bid2, cpr2, qnt2], ...]})
+RULES = {}
+RULES_LOCK = threading.Lock()
+
+
+# Input: identified tokens of one statement ; [R1]B1 >> [R2]B2
+# Output: impl table row [gid, rid1, bid1, cpr1, qnt1, rid2, bid2, cpr2, qnt2], or None if not a rule
+def implrow(tokens: list, gid: int) -> list:
+	mid = next(p for p in range(0, len(tokens), 2) if tokens[p]==I['>>'])
+	row = [gid]
+	for side, cprs in ((tokens[:mid], (I['=t'], *CMPS)), (tokens[mid:], (I['=t'], I['=.']))):
+		if not tokfit(side[:6], [A, None, R, False, B, False]) or len(side) not in (6, 8): return None
+		if not isinstance(side[3], int) or side[3]<0: return None
+		if len(side)==8 and side[6] not in cprs: return None
+		row += [side[3], side[5], side[6] if len(side)==8 else None, side[7] if len(side)==8 else None]
+	return row
+
+
+# Output: SQL creating the impl table
+def implsql() -> str:
+	tbl = DB['table_impl']
+	return '; '.join([
+		f"CREATE TABLE {tbl} (gid BIGINT, rid1 BIGINT, bid1 BIGINT, cpr1 SMALLINT, qnt1 DOUBLE PRECISION, rid2 BIGINT, bid2 BIGINT, cpr2 SMALLINT, qnt2 DOUBLE PRECISION)",
+		f"CREATE INDEX {tbl}_bid_idx ON {tbl} (bid1)",
+		f"GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE {tbl} TO {DB['user']}",
+		implupgradesql(),
+	]) + ';'
+
+
+# Output: SQL bringing the impl table of an older install up to date
+# The unique index holds one rule per premise with its comparison and implied [R]B. The (gid,rid1,bid1) or
+# (gid,rid1,bid1,rid2,bid2) index it replaces dropped [year]adyear>=1950 >> [era]colonial beside [year]adyear<1750 >> [era]colonial
+# {impl}_gen holds each graph's rule generation, seeded for graphs that already have rules
+def implupgradesql() -> str:
+	tbl = DB['table_impl']
+	return '; '.join([
+		f"DROP INDEX IF EXISTS {tbl}_aid_idx",
+		f"CREATE UNIQUE INDEX {tbl}_aid_idx ON {tbl} (gid, rid1, bid1, COALESCE(cpr1, 0), COALESCE(qnt1, 'NaN'), rid2, bid2)",
+		f"CREATE TABLE IF NOT EXISTS {tbl}_gen (gid BIGINT PRIMARY KEY, gen BIGINT)",
+		f"INSERT INTO {tbl}_gen SELECT gid, 1 FROM {tbl} GROUP BY gid ON CONFLICT DO NOTHING",
+		f"GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE {tbl}_gen TO {DB['user']}",
+	])
+
+
+# Input: graph ID
+# Output: the graph's rule generation, which putimpl() bumps, 0 for a graph that never had rules
+# Installs without {impl}_gen count impl rows instead
+def implgen(gid: int) -> int:
+	try: rows = select(f"SELECT gen FROM {DB['table_impl']}_gen WHERE gid=%s", [gid])
+	except psycopg2.errors.UndefinedTable:
+		try: rows = select(f"SELECT COUNT(*) FROM {DB['table_impl']} WHERE gid=%s", [gid])
+		except psycopg2.errors.UndefinedTable: return 0
+	return int(rows[0][0]) if rows else 0
+
+
+# Input: graph ID, check to read the graph's rule generation first
+# Output: the graph's rules, reloaded when check finds a new generation, such as from another process
+def implrules(gid: int, check: bool = False) -> dict:
+	with RULES_LOCK: cached = RULES.get(gid)
+	if cached and not check: return cached[1]
+
+	gen = implgen(gid)
+	if cached and cached[0]==gen: return cached[1]
+
+	rules = {}
+	rows = select(f"SELECT rid1, bid1, cpr1, qnt1, rid2, bid2, cpr2, qnt2 FROM {DB['table_impl']} WHERE gid=%s", [gid]) if gen>0 else []
+	for rid1, bid1, *rule in rows: rules.setdefault((int(rid1), int(bid1)), []).append(rule)
+
+	with RULES_LOCK: RULES[gid] = (gen, rules)
+	return rules
+
+
+# Input: meme rows just written
+# Output: meme rows newly implied by them, already written
+# Semi-naive: each round applies only the rules matching rows the last round added
+# Rules are checked after the rows are written, and putimpl() reads memes after its rules are,
+# so a rule and a meme written at once by two processes always meet
+def infer(memerows: list) -> list:
+	batch = DB.get('copy_batch', 10000)
+	for gid in {row[0] for row in memerows}: implrules(gid, True)
+	derived, delta = [], memerows
+	while delta:
+		implied = {}
+		for gid, aid, rid, bid, qnt in delta:
+			for cpr1, qnt1, rid2, bid2, cpr2, qnt2 in implrules(gid).get((rid, bid), ()):
+				if cpr1 in (None, I['=t']) or (isinstance(qnt, (int, float)) and CMPS[cpr1](qnt, qnt1)): implied[(gid, aid, rid2, bid2)] = qnt2
+
+		# Only rows not already there go on to the next round
+		rows, delta = [[*key, qnt] for key, qnt in implied.items()], []
+		for beg in range(0, len(rows), batch):
+			chunk = rows[beg:beg+batch]
+			delta += select(f"INSERT INTO {DB['table_meme']} VALUES " + ','.join(['(%s,%s,%s,%s,%s)']*len(chunk)) + " ON CONFLICT DO NOTHING RETURNING gid, aid, rid, bid, qnt", [col for row in chunk for col in row])
+		derived += delta
+	return derived
+
+
+# Input: impl table rows from rowify()
+# Output: meme rows the new rules imply from memes already written
+def putimpl(implrows: list) -> list:
+	if not implrows: return []
+	rows = select(f"INSERT INTO {DB['table_impl']} VALUES " + ','.join(['(%s,%s,%s,%s,%s,%s,%s,%s,%s)']*len(implrows)) + " ON CONFLICT DO NOTHING RETURNING gid, rid1, bid1, cpr1, qnt1, rid2, bid2", [col for row in implrows for col in row])
+	with RULES_LOCK:
+		for row in implrows: RULES.pop(row[0], None)
+	if rows:
+		try: insert(f"INSERT INTO {DB['table_impl']}_gen SELECT unnest(%s::BIGINT[]), 1 ON CONFLICT (gid) DO UPDATE SET gen={DB['table_impl']}_gen.gen+1", [sorted({int(row[0]) for row in rows})])
+		except psycopg2.errors.UndefinedTable: pass # implgen() counts rows instead
+
+	# A skipped row must repeat its stored rule, not change what the premise implies
+	added = {tuple(row) for row in rows}
+	for row in implrows:
+		if tuple(row[:7]) in added: continue
+		old = select(f"SELECT cpr2, qnt2 FROM {DB['table_impl']} WHERE gid=%s AND rid1=%s AND bid1=%s AND cpr1 IS NOT DISTINCT FROM %s AND qnt1 IS NOT DISTINCT FROM %s AND rid2=%s AND bid2=%s", row[:7])
+		if not old: raise Exception(f"Rule {row} blocked by an older impl index, run: python3 ./memelang.py implupgrade")
+		if list(old[0])!=row[7:]: raise Exception(f"Conflicting rule {row} for existing {row[:7] + list(old[0])}")
+
+	memerows = []
+	for gid, rid1, bid1, *rule in implrows: memerows += select(f"SELECT gid, aid, rid, bid, qnt FROM {DB['table_meme']} WHERE gid=%s AND rid=%s AND bid=%s", [gid, rid1, bid1])
+	return infer(memerows)
+
+
+###############################################################################
+#                                 PATH TABLES
+###############################################################################
+
+# DB['paths'] declares hot two-hop chains of forward relations, such as 'birth[year'
+# A chain's path table holds one row per walk along it: the first A, the last hop's A, and its B=Q
+# derive() adds the walks that new memes complete, and selectify() reads a matching
+# run of joins from the path table, so [birth[year]adyear>1800 is one lookup instead of a join
+
+# Built chains by graph, as {gid: (load time, [(path table, rids), ...])}, reloaded every DB['stats_ttl'] seconds
+PATHS = {}
+
+
+# Input: chain 'birth[year'
+# Output: name of its path table
+def pathtable(chain: str) -> str:
+	return f"{DB['table_meme']}_path_" + slugify(chain.replace('[', '_'))
+
+
+# Input: chain 'birth[year'
+# Output: its keys ['birth', 'year']
+# A walk's row keeps only the last hop's A, so longer chains would merge walks through different middle nodes
+def pathkeys(chain: str) -> list:
+	keys = chain.split('[')
+	if len(keys)!=2: raise Exception(f"Path chain {chain} must have two hops, such as 'birth[year'")
+	return keys
+
+
+# Input: chain 'birth[year'
+# Output: SQL creating its path table
+def pathsql(chain: str) -> str:
+	pathkeys(chain)
+	tbl = pathtable(chain)
+	return '; '.join([
+		f"CREATE TABLE IF NOT EXISTS {tbl} (gid BIGINT, aid BIGINT, mid BIGINT, bid BIGINT, qnt DOUBLE PRECISION, PRIMARY KEY (gid,aid,mid,bid))",
+		f"CREATE INDEX IF NOT EXISTS {tbl}_bid_idx ON {tbl} (gid, bid, qnt) INCLUDE (aid)",
+		f"GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE {tbl} TO {DB['user']}",
+	]) + ';'
+
+
+# Input: rids of a chain, extra WHERE condition
+# Output: SELECT of its walks as path table rows [gid, aid, mid, bid, qnt]
+def walksql(rids: tuple, where: str = '') -> str:
+	tbl, last = DB['table_meme'], len(rids)-1
+	return (f"SELECT m0.gid, m0.aid, m{last}.aid, m{last}.bid, m{last}.qnt FROM {tbl} m0"
+		+ ''.join(f" JOIN {tbl} m{m} ON m{m}.gid=m0.gid AND m{m}.aid=m{m-1}.bid" for m in range(1, len(rids)))
+		+ ' WHERE ' + ' AND '.join([f"m{m}.rid={int(rid)}" for m, rid in enumerate(rids)] + ([where] if where else []))
+	)
+
+
+# Input: graph ID, wait to load missing or stale paths here instead of in the background
+# Output: [(path table, rids), ...] of declared chains whose table exists and whose keys the graph has
+# Queries read the cache, so nothing is rewritten until the first load finishes
+def pathrids(gid: int, wait: bool = False) -> list:
+	if not DB.get('paths'): return []
+	return cacheload(PATHS, gid, pathload, DB.get('stats_ttl', 300), wait) or []
+
+
+# Input: graph ID
+# Output: pathrids() of the graph, read now
+def pathload(gid: int) -> list:
+	paths = []
+	built = {row[0] for row in select("SELECT t FROM unnest(%s::TEXT[]) t WHERE to_regclass(t) IS NOT NULL", [[pathtable(chain) for chain in DB['paths']]])}
+	for chain in DB['paths']:
+		keys = pathkeys(chain)
+		if pathtable(chain) not in built: continue
+		ids = keyids(keys, [gid])
+		if all(isinstance(ids.get(key), int) for key in keys): paths.append((pathtable(chain), tuple(ids[key] for key in keys)))
+	return paths
+
+
+# Input: joins from joinify(), pathrids() of the graph
+# Output: joins with each run matching a chain swapped for one {'path': (table, rids)} join
+# Only the last hop of a run may have a B, a Q, or be selected past its R
+def pathify(joins: list, paths: list) -> list:
+	paths = sorted(paths, key=lambda path: -len(path[1]))
+	out, m = [], 0
+	while m < len(joins):
+		for table, rids in paths:
+			run = joins[m:m+len(rids)]
+			if len(run)==len(rids) and all(
+				not join['inv'] and join['whr'].get(R)==rid and join['whr'][C]!=I['=$']
+				and (n==len(rids)-1 or (join['whr'][C]==I['=.'] and B not in join['whr'] and Q not in join['whr'] and not join['sel'].get(B) and not join['sel'].get(Q)))
+				for n, (join, rid) in enumerate(zip(run, rids))
+			):
+				whr = {key: val for key, val in run[-1]['whr'].items() if key not in (A, R)}
+				if A in run[0]['whr']: whr[A] = run[0]['whr'][A]
+				out.append({'inv': False, 'path': (table, rids), 'sel': run[-1]['sel'], 'whr': whr})
+				m += len(rids)
+				break
+		else:
+			out.append(joins[m])
+			m += 1
+	return out
+
+
+# Input: chain 'birth[year'
+# Output: walks added to its path table, across every graph with its keys
+def pathbuild(chain: str) -> int:
+	keys = pathkeys(chain)
+	gids = [int(row[0]) for row in select(f"SELECT DISTINCT gid FROM {DB['table_name']} WHERE rid=%s AND bid=%s AND qnt=%s", [I['nam'], I['key'], keys[0]])]
+	added = 0
+	for gid in gids:
+		ids = keyids(keys, [gid])
+		if not all(isinstance(ids.get(key), int) for key in keys): continue
+		added += select(f"WITH w AS (INSERT INTO {pathtable(chain)} " + walksql(tuple(ids[key] for key in keys), f"m0.gid={gid}") + " ON CONFLICT DO NOTHING RETURNING 1) SELECT COUNT(*) FROM w")[0][0]
+	with LOADS_LOCK: PATHS.clear()
+	return added
+
+
+# Input: meme rows just written
+# Adds the walks they complete to the path tables
+# A new meme at hop n joins the memes already written on both sides of it
+# A chain pathrids() left out, for a table or key missing when it loaded, is looked up fresh
+# only when a written R is one of its keys, as that key or table may be new since
+def pathsync(memerows: list):
+	if not memerows or not DB.get('paths'): return
+	hops, paths = {}, {}
+	for gid in {row[0] for row in memerows}:
+		paths[gid] = pathrids(gid, True)
+		built = {table for table, rids in paths[gid]}
+		pending = {key for chain in DB['paths'] if pathtable(chain) not in built for key in pathkeys(chain)}
+		if pending and pending & set(idkeys({row[2] for row in memerows if row[0]==gid}, [gid]).values()):
+			paths[gid] = cacheload(PATHS, gid, pathload, 0, True)
+
+	for gid, aid, rid, bid, qnt in memerows:
+		for table, rids in paths[gid]:
+			for n, hrid in enumerate(rids):
+				if rid!=hrid: continue
+				pairs = hops.setdefault((table, rids, gid, n), ([], []))
+				pairs[0].append(aid)
+				pairs[1].append(bid)
+
+	for (table, rids, gid, n), (aids, bids) in hops.items():
+		insert(f"INSERT INTO {table} " + walksql(rids, f"m0.gid={int(gid)} AND (m{n}.aid, m{n}.bid) IN (SELECT * FROM unnest(%s::BIGINT[], %s::BIGINT[]))") + " ON CONFLICT DO NOTHING", [aids, bids])
+
+
+# Input: meme rows and impl table rows just written
+# Output: the meme rows plus those they imply, already written, with their walks in the path tables
+def derive(memerows: list, implrows: list = []) -> list:
+	memerows = memerows + putimpl(implrows) + infer(memerows)
+	pathsync(memerows)
+	return memerows
+
+
+###############################################################################
+#                                  ASYNC API
+###############################################################################
+
+# aquery(), acount() and aput() await asyncpg, with one connection pool per event loop
+# They share decode(), identify(), planify(), rowify() and the caches with the sync API
+# Only the DB round-trips are awaited, so one loop can keep hundreds of queries in flight
+
+# (event loop, pool creation task) by id of the loop
+# A task holds its loop, so entries are dropped by apool() once their loop closes, or by aclose_pool()
+APOOLS = {}
+
+
+# Returned connections skip asyncpg's reset round-trip, as with the sync pool
+async def areset(conn): pass
+
+
+# Output: the running loop's asyncpg pool, opened on first use
+async def apool():
+	if asyncpg is None: raise Exception('The async API needs asyncpg: pip install asyncpg')
+	loop = asyncio.get_running_loop()
+	# asyncpg prepares every statement, so keep per-value plans like the sync path unless DB['plan_prepare']
+	settings = {} if DB.get('plan_prepare') else {'plan_cache_mode': 'force_custom_plan'}
+	entry = APOOLS.get(id(loop))
+	if not entry or entry[0] is not loop:
+		apoolprune()
+		entry = APOOLS[id(loop)] = (loop, asyncio.ensure_future(asyncpg.create_pool(host=DB['host'], database=DB['name'], user=DB['user'], password=DB['pass'], min_size=DB.get('pool_min', 1), max_size=DB.get('pool_max', 10), server_settings=settings, reset=areset)))
+	try: return await entry[1]
+	except Exception:
+		APOOLS.pop(id(loop), None)
+		raise
+
+
+# Drop the pools of closed event loops, such as those of finished asyncio.run() calls
+# Their connections can't be closed without their loop, so they close when garbage collected
+def apoolprune():
+	for key, (loop, task) in list(APOOLS.items()):
+		if loop.is_closed(): APOOLS.pop(key, None)
+
+
+# Close the running loop's pool
+async def aclose_pool():
+	entry = APOOLS.pop(id(asyncio.get_running_loop()), None)
+	if entry: await (await entry[1]).close()
+
+
+# asyncpg prepares and caches each statement per connection, like DB['plan_prepare']
+async def aselect(sql: str, params: list = []) -> list:
+	pool = await apool()
+	with timing('select', {'sql': sql, 'params': params, 'async': True}) as info:
+		rows = await pool.fetch(dollarify(sql), *params)
+		info['rows'] = len(rows)
+	return [list(row) for row in rows]
+
+
+async def ainsert(sql: str, params: list = []):
+	pool = await apool()
+	with timing('insert', {'sql': sql, 'params': params, 'async': True}): await pool.execute(dollarify(sql), *params)
+
+
+# Input: 'qnt' and keys, or 'aid' and IDs
+# Output: their key name rows
+# One array parameter instead of IN (...), so every lookup reuses one prepared statement
+async def anamerows(col: str, vals, gids: list[int]) -> list:
+	return await aselect(f"SELECT DISTINCT * FROM {DB['table_name']} WHERE {col} = ANY(%s) AND rid=%s AND bid=%s AND gid = ANY(%s)", [list(vals), I['nam'], I['key'], list(gids)])
+
+
+# Run func on a thread when DB['result_store'] makes its result cache calls SQLite writes
+# For resultget(), resultput() and memesync()
+async def astore(func, *args):
+	if DB.get('result_store'): return await asyncio.to_thread(func, *args)
+	return func(*args)
+
+
+# Create the keycache() of each graph on a thread the first time, as DB['key_preload'] reads the DB
+async def akeycaches(gids: list[int]):
+	with KEYS_LOCK: missing = [gid for gid in gids if gid not in KEYS]
+	for gid in missing: await asyncio.to_thread(keycache, gid)
+
+
+# slowlog() on a thread, as EXPLAIN and the log file block
+async def aslowlog(memestr: str, sql: str, params: list, rows: list, secs: float):
+	if DB.get('slow_ms') and secs*1000 >= DB['slow_ms']: await asyncio.to_thread(slowlog, memestr, sql, params, rows, secs)
+
+
+# Async keyids(), filling the same key caches
+async def akeyids(keys, gids: list[int] = []) -> dict:
+	if not gids: gids = [GID]
+	found, lookups = keyfind(keys, gids)
+	if lookups: keyrows(await anamerows('qnt', lookups.keys(), gids), gids, found)
+	return found
+
+
+# Async idkeys(), filling the same key caches
+async def aidkeys(iids, gids: list[int] = []) -> dict:
+	if not gids: gids = [GID]
+	found, lookups = keyfind(iids, gids, True)
+	if lookups: keyrows(await anamerows('aid', lookups.keys(), gids), gids, found, True)
+	return found
+
+
+# Output: count unused IDs, reserved from the sequence DB['id_block'] at a time
+async def anewids(count: int) -> list:
+	ids = []
+	while True:
+		with IDS_LOCK:
+			if IDS['pid'] != os.getpid(): IDS['pid'], IDS['free'] = os.getpid(), []
+			while IDS['free'] and len(ids) < count: ids.append(IDS['free'].pop())
+		if len(ids) >= count: return ids
+
+		sql, params = f"SELECT nextval('{idseq()}') FROM generate_series(1, %s)", [max(count-len(ids), DB.get('id_block', 1000))]
+		try: rows = await aselect(sql, params)
+		except asyncpg.exceptions.UndefinedTableError:
+			await asyncio.to_thread(seqsync)
+			rows = await aselect(sql, params)
+		with IDS_LOCK:
+			IDS['free'] = sorted(IDS['free'] + [int(row[0]) for row in rows], reverse=True)
+			IDS['top'] = max(IDS['top'], IDS['free'][0])
+
+
+# Async identify(), looking up keys before identify()
+async def aidentify(tokens: list, gids: list[int] = [], fset={}) -> list:
+	if not gids: gids = [GID]
+	if not fset.get('keysql'):
+		keys = [tokens[t+1].lstrip('-') for t in range(START, len(tokens), 2) if isinstance(tokens[t+1], str) and OPR[tokens[t]][FORM]==KEY]
+		found = await akeyids(keys, gids)
+		for key in keys:
+			if key not in found: raise Exception(f"identify error {key}")
+		return identify(tokens, gids, fset, found)
+	return identify(tokens, gids, fset)
+
+
+# Async keyify(), looking up IDs before keyify()
+async def akeyify(tokens: list, gids: list[int] = []) -> list:
+	if not gids: gids = [GID]
+	return keyify(tokens, gids, await aidkeys([abs(tokens[t+1]) for t in range(START, len(tokens), 2) if isinstance(tokens[t+1], int) and OPR[tokens[t]][FORM]==KEY], gids))
+
+
+# Async query()
+async def aquery(memestr: str, gids: list[int] = [], fset={}) -> str:
+	if not gids: gids = [GID]
+	fset = {'keysql': DB.get('key_sql', False), 'opt': DB.get('sql_opt', False), **fset}
+
+	start = time.perf_counter()
+
+	with timing('decode'): tokens = decode(memestr)
+	key = ('query', tuple(tokens), tuple(gids))
+	cached, gens = await astore(resultget, key, gids) if fset.get('cache', True) else (None, None)
+	if cached is not None: return cached
+
+	graph = memgraph(gids, False) if fset.get('mem', True) else None
+	if graph: return await astore(resultput, key, gens, graph.query(memestr, gids))
+
+	await akeycaches(gids)
+	with timing('identify'): tokens = await aidentify(tokens, gids, fset)
+	with timing('querify'): sql, params, name = planify(tokens, gids, fset)
+	res = await aselect(sql, params)
+
+	if not res or not res[0] or not res[0][0]: out = ''
+	else:
+		with timing('keyify'): out = encode(await akeyify(tokenify(res[0][0], gids), gids))
+
+	await aslowlog(memestr, sql, params, res, time.perf_counter()-start)
+	return await astore(resultput, key, gens, out)
+
+
+# Async count()
+async def acount(memestr: str, gids: list[int] = [], fset={}) -> int:
+	if not gids: gids = [GID]
+	fset = {'keysql': DB.get('key_sql', False), 'opt': DB.get('sql_opt', False), **fset}
+
+	start = time.perf_counter()
+
+	with timing('decode'): tokens = decode(memestr)
+	key = ('count', tuple(tokens), tuple(gids))
+	cached, gens = await astore(resultget, key, gids) if fset.get('cache', True) else (None, None)
+	if cached is not None: return cached
+
+	graph = memgraph(gids, False) if fset.get('mem', True) else None
+	if graph: return await astore(resultput, key, gens, graph.count(memestr, gids))
+
+	await akeycaches(gids)
+	with timing('identify'): tokens = await aidentify(tokens, gids, fset)
+	with timing('querify'): sql, params, name = planify(tokens, gids, {**countset(fset), 'count': True})
+	res = await aselect(sql, params)
+	await aslowlog(memestr, sql, params, res, time.perf_counter()-start)
+	return await astore(resultput, key, gens, int(res[0][0]) if res and res[0] else 0)
+
+
+# Async claimkeys()
+# Output: whether every new key kept the ID in its name row
+async def aclaimkeys(namerows: list) -> bool:
+	gid = namerows[0][0]
+	if kid := seqpast(namerows): seqcheck(kid, int((await aselect(f"SELECT last_value FROM {idseq()}"))[0][0]))
+	await ainsert(f"INSERT INTO {DB['table_name']} VALUES " + ','.join(['(%s,%s,%s,%s,%s)']*len(namerows)) + " ON CONFLICT DO NOTHING", [col for row in namerows for col in row])
+	cache = keycache(gid)
+	rows = [list(row) for row in await anamerows('qnt', [row[4] for row in namerows], [gid])]
+	claimcheck(namerows, rows)
+	for row in rows: cache.add(row[4], int(row[1]))
+	await astore(memesync, rows)
+	won = {row[4]: int(row[1]) for row in rows}
+	return all(won.get(row[4])==int(row[1]) for row in namerows)
+
+
+# Async put()
+# Known keys are looked up first, so rowify() finds them in the cache
+async def aput(memestr: str, gids: list[int] = []) -> str:
+	if not gids: gids = [GID]
+	gid=gids[-1]
+
+	await akeycaches(gids)
+	with timing('decode'): tokens = decode(memestr)
+	keys = set()
+	for t in range(START, len(tokens), 2):
+		if not isinstance(tokens[t+1], str): continue
+		if OPR[tokens[t]][FORM]==KEY: keys.add(tokens[t+1].lstrip('-').lower())
+		elif t>=8 and tokfit(tokens, [A, False, R, I['nam'], B, I['key'], I['=$'], False], t-6): keys.add(tokens[t+1].lower())
+	found = await akeyids(keys, gids)
+	ids = iter(await anewids(len(keys - found.keys())))
+
+	decoded = list(tokens) # rowify() swaps IDs into tokens in place
+	with timing('rowify'): tokens, namerows, memerows, implrows = rowify(tokens, gids, ids, {'cached': True})
+
+	# A concurrent writer claimed a new key first, so rowify() again with its ID from the cache
+	# Each lost key is cached by then, so a few rounds always settle
+	for _ in range(4):
+		if not namerows or await aclaimkeys(namerows): break
+		ids = iter(await anewids(len(namerows)))
+		with timing('rowify'): tokens, namerows, memerows, implrows = rowify(list(decoded), gids, ids, {'cached': True})
+	else:
+		if namerows: raise Exception('Could not claim keys: ' + ' '.join(row[4] for row in namerows))
+
+	if memerows: memerows = await aselect(f"INSERT INTO {DB['table_meme']} VALUES " + ','.join(['(%s,%s,%s,%s,%s)']*len(memerows)) + " ON CONFLICT DO NOTHING RETURNING gid, aid, rid, bid, qnt", [col for row in memerows for col in row])
+	with timing('derive'): memerows = await asyncio.to_thread(derive, memerows, implrows) # Rules and paths change rarely, so on the sync pool
+	await astore(memesync, [], memerows)
+
+	return keyencode(tokens, [gid])
+
+
+###############################################################################
+#                              BULK LOADING
+###############################################################################
+
+# Input: rows of values
+# Output: text for COPY ... FROM STDIN
+def copytext(rows: list) -> io.StringIO:
+	buf = io.StringIO()
+	for row in rows:
+		buf.write('\t'.join('\\N' if col is None else str(col).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r') for col in row) + '\n')
+	buf.seek(0)
+	return buf
+
+
+# COPY rows into tbl through a temp table, skipping rows already there
+# Output: the rows written
+def copyrows(cursor, tbl: str, rows: list) -> list:
+	if not rows: return []
+	cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {tbl}_copy (LIKE {tbl}) ON COMMIT DELETE ROWS")
+	cursor.copy_expert(f"COPY {tbl}_copy FROM STDIN", copytext(rows))
+	cursor.execute(f"INSERT INTO {tbl} SELECT DISTINCT ON (gid,aid,rid,bid) * FROM {tbl}_copy ON CONFLICT DO NOTHING RETURNING *")
+	return [list(row) for row in cursor.fetchall()]
+
+
+# Input: path to a .meme file, byte offset to resume from
+# Output: generator of (byte offset, memes processed) after each committed batch
+# Reads DB['copy_batch'] lines at a time, so memory stays flat for any file size
+# New keys take IDs from newid() blocks and are claimed before their memes,
+# so several loaders can share keys
+# Each batch commits in one transaction; restart from the last offset to resume
+def putstream(file_path: str, gids: list[int] = [], offset: int = 0, batch: int = None):
 	if not gids: gids = [GID]
-	tokens = idecode(memestr, gids)
-	sql, params = querify(tokens, gids)
-	res=select(sql, params)
-	return 0 if not res or not res[0] or not res[0][0] else res[0][0].count(';')
+	batch = batch or DB.get('copy_batch', 10000)
+	ids = newids()
+	memecnt = 0
+
+	with open(file_path, 'rb') as f:
+		f.seek(offset)
+		while True:
+			lines, quotes = [], 0
+
+			# Whole lines, never splitting a quote
+			while len(lines) < batch or quotes%2:
+				line = f.readline()
+				if not line: break
+				lines.append(line.decode('utf-8'))
+				quotes += len(QUOTE.findall(lines[-1]))
+
+			if not lines: break
+			memestr = ''.join(lines)
+
+			if COMMENT.sub('', memestr).strip():
+				tokens, namerows, memerows, implrows = rowify(decode(memestr), gids, ids, {'claim': True})
+				memecnt += len(memerows)
+				with pooled() as conn:
+					with conn.cursor() as cursor:
+						memerows = copyrows(cursor, DB['table_meme'], memerows)
+						copyrows(cursor, DB['table_name'], namerows)
+				memerows = derive(memerows, implrows)
+				memesync(namerows, memerows)
+
+			offset = f.tell()
+			yield offset, memecnt
+
+
+# Input: graph ID
+# Output: {'orphans': memes whose A, R or B key has no name, 'dupes': keys with several IDs}
+def keycheck(gid: int = GID) -> dict:
+	meme_table, name_table = DB['table_meme'], DB['table_name']
+	named = f"SELECT 1 FROM {name_table} n WHERE n.gid=m.gid AND n.rid={I['nam']} AND n.bid={I['key']} AND n.aid="
+	orphans = select(f"""SELECT COUNT(*) FROM {meme_table} m WHERE m.gid=%s AND (
+		(m.aid>{I['cor']} AND NOT EXISTS ({named}m.aid))
+		OR (m.rid>{I['cor']} AND NOT EXISTS ({named}m.rid))
+		OR (m.bid>{I['cor']} AND NOT EXISTS ({named}m.bid)))""", [gid])
+	dupes = select(f"SELECT COUNT(*) FROM (SELECT qnt FROM {name_table} WHERE gid=%s AND rid={I['nam']} AND bid={I['key']} GROUP BY qnt HAVING COUNT(DISTINCT aid)>1) d", [gid])
+	return {'orphans': int(orphans[0][0]), 'dupes': int(dupes[0][0])}
+
+
+# Input: path to a .meme file
+# Output: (path, memes, seconds), for putfiles() workers
+def putfile(file_path: str, gids: list[int] = []) -> tuple[str, int, float]:
+	start, memecnt = time.time(), 0
+	for offset, memecnt in putstream(file_path, gids): pass
+	return file_path, memecnt, time.time()-start
+
+
+# Input: paths to .meme files, number of worker processes
+# Output: generator of putfile() results as each file finishes
+# Each worker has its own pool and ID block; shared keys get one ID via claimkeys()
+def putfiles(file_paths: list[str], workers: int = None, gids: list[int] = []):
+	workers = workers or os.cpu_count()
+	with multiprocessing.Pool(min(workers, len(file_paths)) or 1) as procs:
+		yield from procs.imap_unordered(functools.partial(putfile, gids=gids), file_paths)
+
+
+###############################################################################
+#                           BINARY .memeb FILES
+###############################################################################
+
+# Header: magic, gid, key count, record count, byte offset of records
+# Then per key: aid, byte length, UTF-8 key
+# Then records of five 64-bit words: gid, aid, rid, bid, qnt word
+# The qnt word is a pack() word for =. (0 for NULL), so quantities keep six decimals
+MEMEB_MAGIC = b'MEMEB\x00\x00\x01'
+MEMEB_HEAD = struct.Struct('<8sqQQQ')
+MEMEB_KEY = struct.Struct('<qH')
+MEMEB_WORDS = 5
+
+
+# Input: meme table qnt
+# Output: 64-bit qnt word
+def qntword(qnt) -> int:
+	if qnt is None: return 0
+	operand = int(qnt*1000000)
+	if not (-1<<56<=operand<1<<56): raise ValueError(f'operand range {operand}')
+	return (I['=.']<<57)|(operand&((1<<57)-1))
+
+
+# Input: 64-bit qnt word
+# Output: meme table qnt
+def wordqnt(word: int):
+	if word == 0: return None
+	operand = word&((1<<57)-1)
+	if operand >= (1<<56): operand-=1<<57
+	return float(operand/1000000)
+
+
+# Export one graph's memes and keys to a .memeb file
+# Output: number of records
+def memebwrite(file_path: str, gid: int = GID) -> int:
+	if sys.byteorder != 'little': raise Exception('.memeb files need a little-endian host')
+	size = DB.get('fetch_size', 1000)
+	keycnt = memecnt = 0
+
+	with open(file_path, 'wb') as f, pooled() as conn:
+		f.write(MEMEB_HEAD.pack(MEMEB_MAGIC, gid, 0, 0, 0))
+
+		with conn.cursor(name=f"memeb{next(CURSOR_IDS)}") as cursor:
+			cursor.execute(f"SELECT aid, qnt FROM {DB['table_name']} WHERE gid=%s AND rid=%s AND bid=%s ORDER BY aid", [gid, I['nam'], I['key']])
+			while rows := cursor.fetchmany(size):
+				for aid, key in rows:
+					key = key.encode('utf-8')
+					f.write(MEMEB_KEY.pack(int(aid), len(key)) + key)
+				keycnt += len(rows)
+
+		recoff = -(-f.tell()//8)*8 # 8-byte aligned for mmap views
+		f.write(b'\x00'*(recoff-f.tell()))
+
+		with conn.cursor(name=f"memeb{next(CURSOR_IDS)}") as cursor:
+			cursor.execute(f"SELECT gid, aid, rid, bid, qnt FROM {DB['table_meme']} WHERE gid=%s ORDER BY aid, rid, bid", [gid])
+			while rows := cursor.fetchmany(size):
+				words = array('Q')
+				for row in rows: words.extend((int(row[0]), int(row[1])&((1<<64)-1), int(row[2])&((1<<64)-1), int(row[3])&((1<<64)-1), qntword(row[4])))
+				words.tofile(f)
+				memecnt += len(rows)
+
+		f.seek(0)
+		f.write(MEMEB_HEAD.pack(MEMEB_MAGIC, gid, keycnt, memecnt, recoff))
+
+	return memecnt
+
+
+# Memory-mapped .memeb reader
+# Records stay in the file; find() and rows() read them in place
+class MemebReader:
+	def __init__(self, file_path: str):
+		if sys.byteorder != 'little': raise Exception('.memeb files need a little-endian host')
+		self.file = open(file_path, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.gid, keycnt, self.count, recoff = MEMEB_HEAD.unpack_from(self.map, 0)
+		if magic != MEMEB_MAGIC: raise Exception(f'Not a .memeb file {file_path}')
+
+		# Key dictionary
+		self.keys, self.ids, pos = {}, {}, MEMEB_HEAD.size
+		for _ in range(keycnt):
+			aid, klen = MEMEB_KEY.unpack_from(self.map, pos)
+			pos += MEMEB_KEY.size
+			key = self.map[pos:pos+klen].decode('utf-8')
+			pos += klen
+			self.keys[aid], self.ids[key] = key, aid
+
+		self.words = memoryview(self.map)[recoff:recoff+self.count*MEMEB_WORDS*8].cast('Q')
+
+	def close(self):
+		self.words.release()
+		self.map.close()
+		self.file.close()
+
+	def __enter__(self): return self
+	def __exit__(self, *args): self.close()
+	def __len__(self) -> int: return self.count
+
+	# Output: [gid, aid, rid, bid, qnt] for record n
+	def row(self, n: int) -> list:
+		w = n*MEMEB_WORDS
+		gid, aid, rid, bid, qword = self.words[w:w+MEMEB_WORDS]
+		signed = lambda word: word-(1<<64) if word>=(1<<63) else word
+		return [signed(gid), signed(aid), signed(rid), signed(bid), wordqnt(qword)]
+
+	# Output: generator of row() from record beg to end
+	def rows(self, beg: int = 0, end: int = None):
+		for n in range(beg, self.count if end is None else end): yield self.row(n)
+
+	# Input: aid, rid and/or bid as IDs or keys
+	# Output: generator of matching row()
+	# Records are sorted by aid, so an aid lookup is a binary search
+	def find(self, aid=None, rid=None, bid=None):
+		aid, rid, bid = (self.ids.get(x, I.get(x, 0)) if isinstance(x, str) else x for x in (aid, rid, bid))
+		beg, end = 0, self.count
+		if aid is not None:
+			col = lambda n: self.words[n*MEMEB_WORDS+1]
+			beg = bisect.bisect_left(range(self.count), aid, key=col)
+			end = bisect.bisect_right(range(self.count), aid, key=col)
+		for row in self.rows(beg, end):
+			if (rid is None or row[2]==rid) and (bid is None or row[3]==bid): yield row
+
+	# Input: row()
+	# Output: Memelang string "a[r]b=q"
+	def encode(self, row: list) -> str:
+		key = lambda iid: self.keys.get(iid) or K.get(iid) or str(iid)
+		memestr = f"{key(row[1])}[{key(row[2])}]{key(row[3])}"
+		if row[4] is None: return memestr
+		return memestr + '=' + str(int(row[4]) if row[4].is_integer() else row[4])
+
+
+# Bulk-load a .memeb file into graph gids[-1] without text parsing
+# File IDs are remapped to this DB's IDs by key; unknown keys get newid() IDs
+# Output: number of records
+def memebload(file_path: str, gids: list[int] = [], batch: int = None) -> int:
+	if not gids: gids = [GID]
+	gid, batch = gids[-1], batch or DB.get('copy_batch', 10000)
+
+	with MemebReader(file_path) as reader:
+		found = keyids(list(reader.ids), [gid])
+		namerows = [[gid, newid(), I['nam'], I['key'], key] for key in reader.ids if key not in found]
+		for beg in range(0, len(namerows), batch): claimkeys(namerows[beg:beg+batch])
+		found = keyids(list(reader.ids), [gid])
+		idmap = {aid: found[key] for aid, key in reader.keys.items()}
+
+		for beg in range(0, len(reader), batch):
+			memerows = [[gid, idmap.get(row[1], row[1]), idmap.get(row[2], row[2]), idmap.get(row[3], row[3]), row[4]] for row in reader.rows(beg, min(beg+batch, len(reader)))]
+			with pooled() as conn:
+				with conn.cursor() as cursor: memerows = copyrows(cursor, DB['table_meme'], memerows)
+			memesync([], derive(memerows))
+
+		return len(reader)
+
+
+###############################################################################
+#                            IN-MEMORY GRAPHS
+###############################################################################
+
+# Quantity comparisons for MemGraph joins, NULL (NaN) never matches
+CMPS = {
+	I['=.'] : lambda qnt, x: qnt==x,
+	I['>']  : lambda qnt, x: qnt>x,
+	I['<']  : lambda qnt, x: qnt<x,
+	I['>='] : lambda qnt, x: qnt>=x,
+	I['<='] : lambda qnt, x: qnt<=x,
+	I['!='] : lambda qnt, x: qnt==qnt and qnt!=x,
+}
+
+
+# Input: SQL LIKE pattern
+# Output: compiled regex for fullmatch()
+@functools.lru_cache(maxsize=256)
+def likere(pattern: str):
+	return re.compile(''.join('.*' if c=='%' else '.' if c=='_' else re.escape(c) for c in pattern), flags=re.DOTALL)
+
+
+# Rows per key of a MemGraph index, read like a graphstats() count dict
+class IndexCounts:
+	def __init__(self, index: dict): self.index = index
+	def get(self, key, default=0):
+		rows = self.index.get(key)
+		return default if rows is None else len(rows)
+
+
+# In-process copy of some graphs that answers queries without the DB
+# Both tables are kept as columns, memes with hash indexes on aid, rid, bid and (bid, rid)
+# Runs the same joinify() and clausify() plans as querify(), so results match the SQL
+class MemGraph:
+	def __init__(self, gids: list[int] = []):
+		self.gids = list(gids or [GID])
+		self.memes = {col: array('q') for col in ('gid', 'aid', 'rid', 'bid')}
+		self.memes['qnt'] = array('d')	# NaN for NULL
+		self.names = {col: [] for col in ('gid', 'aid', 'rid', 'bid', 'qnt')}
+		self.index = {
+			id(self.memes): {'aid': {}, 'rid': {}, 'bid': {}, 'bid,rid': {}},
+			id(self.names): {'aid': {}},
+		}
+		self.ids = {gid: {} for gid in self.gids}	# key -> id per graph
+		self.keys = {gid: {} for gid in self.gids}	# id -> key per graph
+		self.lock = threading.Lock()
+
+	def __len__(self) -> int: return len(self.memes['aid'])
+
+	# Load this object's graphs from the DB
+	# Output: number of memes
+	def load(self) -> int:
+		size = DB.get('copy_batch', 10000)
+		gidlist = ','.join(str(int(gid)) for gid in self.gids)
+		with pooled() as conn:
+			for tbl, add in ((DB['table_name'], self.addnames), (DB['table_meme'], self.addmemes)):
+				with conn.cursor(name=f"memegraph{next(CURSOR_IDS)}") as cursor:
+					cursor.execute(f"SELECT gid, aid, rid, bid, qnt FROM {tbl} WHERE gid IN ({gidlist})")
+					while rows := cursor.fetchmany(size): add(rows, False)
+		return len(self)
+
+	# Load a .memeb file of one of this object's graphs, keeping its IDs
+	# Output: number of memes
+	def loadfile(self, file_path: str) -> int:
+		with MemebReader(file_path) as reader:
+			if reader.gid not in self.ids: raise Exception(f'Graph {reader.gid} is not in this MemGraph')
+			self.addnames(([reader.gid, aid, I['nam'], I['key'], key] for aid, key in reader.keys.items()), False)
+			self.addmemes(reader.rows(), False)
+		return len(self)
+
+	# Input: table columns, rows, check=False skips the primary key check for fresh loads
+	# Rows of other graphs are ignored
+	def addrows(self, tbl: dict, rows, check: bool = True):
+		index = self.index[id(tbl)]
+		with self.lock:
+			for gid, aid, rid, bid, qnt in rows:
+				gid, aid, rid, bid = int(gid), int(aid), int(rid), int(bid)
+				if gid not in self.ids: continue
+				if check and any(tbl['gid'][n]==gid and tbl['rid'][n]==rid and tbl['bid'][n]==bid for n in index['aid'].get(aid, ())): continue
+				n = len(tbl['aid'])
+				for col, val in (('gid', gid), ('aid', aid), ('rid', rid), ('bid', bid)): tbl[col].append(val)
+				if tbl is self.memes: tbl['qnt'].append(float('nan') if qnt is None else float(qnt))
+				else:
+					tbl['qnt'].append(qnt)
+					if rid==I['nam'] and bid==I['key']: self.ids[gid][qnt], self.keys[gid][aid] = aid, qnt
+				for col, val in (('aid', aid), ('rid', rid), ('bid', bid), ('bid,rid', (bid, rid))):
+					if col in index: index[col].setdefault(val, []).append(n)
+
+	# Output: graphstats() of all this object's graphs, read off the indexes
+	def stats(self) -> dict:
+		index = self.index[id(self.memes)]
+		return {'rows': len(self), 'aids': len(index['aid']) or 1, 'rid': IndexCounts(index['rid']), 'bid': IndexCounts(index['bid'])}
+
+	def addmemes(self, rows, check: bool = True): self.addrows(self.memes, rows, check)
+	def addnames(self, rows, check: bool = True): self.addrows(self.names, rows, check)
+
+	# Input: join from joinify()
+	# Output: the table it reads
+	def table(self, join: dict) -> dict:
+		return self.names if join['whr'][C]==I['=$'] else self.memes
+
+	# Input: join from joinify(), ID its A column must equal or None
+	# Output: row numbers to check, from the smallest usable index
+	def candidates(self, join: dict, aid: int = None):
+		tbl = self.table(join)
+		index, inv = self.index[id(tbl)], join['inv']
+		acol, bcol = ('bid', 'aid') if inv else ('aid', 'bid')
+		rid, bid = join['whr'].get(R) or None, join['whr'].get(B) or None
+
+		cands = []
+		for col, val in ((acol, aid), (bcol, bid), ('rid', rid), ('bid,rid', (aid if inv else bid, rid))):
+			if col in index and None not in (val if col=='bid,rid' else (val,)): cands.append(index[col].get(val, ()))
+		return min(cands, key=len) if cands else range(len(tbl['aid']))
+
+	# Input: join from joinify(), gids, ID forwarded by the previous join
+	# Output: matching row numbers
+	def match(self, join: dict, gids: list[int], aid: int = None) -> list:
+		whr, inv = join['whr'], join['inv']
+		tbl = self.table(join)
+		acol, bcol = ('bid', 'aid') if inv else ('aid', 'bid')
+		if aid is None: aid = whr.get(A) or None # A is only ever in the first join
+		rid, bid, qnt = whr.get(R) or None, whr.get(B) or None, whr.get(Q) or None
+
+		if qnt is None: cmp = None
+		elif tbl is self.names: cmp = lambda val, x, like=likere(qnt): val is not None and like.fullmatch(val)
+		else: cmp = CMPS[whr[C]]
+
+		gidcol, acols, rids, bcols, qnts = tbl['gid'], tbl[acol], tbl['rid'], tbl[bcol], tbl['qnt']
+		return [n for n in self.candidates(join, aid) if gidcol[n] in gids
+			and (aid is None or acols[n]==aid)
+			and (rid is None or rids[n]==rid)
+			and (bid is None or bcols[n]==bid)
+			and (cmp is None or cmp(qnts[n], qnt))]
+
+	# Input: join from joinify(), gids, IDs forwarded by the previous join
+	# Output: {forwarded ID: matching row numbers}
+	# Looks each ID up in the indexes, or hash joins one pass over the join's rows when that is smaller
+	def lookup(self, join: dict, gids: list[int], fwds: set) -> dict:
+		if len(self.candidates(join)) > 8*len(fwds): return {fwd: self.match(join, gids, fwd) for fwd in fwds}
+		acols = self.table(join)['bid' if join['inv'] else 'aid']
+		found = {}
+		for n in self.match(join, gids):
+			if acols[n] in fwds: found.setdefault(acols[n], []).append(n)
+		return found
+
+	# Input: tokens and bounds of one clause, as for selectify()
+	# Output: [(a0, m0.aid, result statement tuple), ...]
+	def select(self, tokens: list, gids: list[int], beg: int = 0, end: int = None) -> list:
+		joins = joinify(tokens, gids, beg, end)
+		tbls = [self.table(join) for join in joins]
+
+		# Row number per join, each joined on the column the one before forwards
+		paths = [(n,) for n in self.match(joins[0], gids)]
+		for m in range(1, len(joins)):
+			fcol = tbls[m-1]['aid' if tbls[m-1] is self.names or joins[m-1]['inv'] else 'bid']
+			found = self.lookup(joins[m], gids, {fcol[path[-1]] for path in paths})
+			paths = [path+(n,) for path in paths for n in found.get(fcol[path[-1]], ())]
+
+		# Columns each join selects: rid and its sign, bid or None, qnt or None, and C
+		outs = [(tbl['rid'], -1 if join['inv'] else 1,
+			tbl['aid' if join['inv'] else 'bid'] if join['sel'].get(B) else None,
+			tbl['qnt'] if join['sel'].get(Q) else None,
+			join['whr'][C]) for join, tbl in zip(joins, tbls)]
+
+		res = []
+		a0s, aids = tbls[0]['bid' if joins[0]['inv'] else 'aid'], tbls[0]['aid']
+		for path in paths:
+			statement = [I[';'], a0s[path[0]]]
+			for (rids, sign, bids, qnts, cpr), n in zip(outs, path):
+				statement += (I['['], rids[n]*sign)
+				if bids is not None: statement += (I[']'], bids[n])
+				if qnts is not None:
+					qnt = qnts[n]
+					if isinstance(qnt, float) and qnt==qnt: statement += (cpr, int(qnt) if qnt.is_integer() else qnt)
+					elif isinstance(qnt, str): statement += (cpr, qnt)
+			res.append((a0s[path[0]], aids[path[0]], tuple(statement)))
+		return res
+	# Input: identified tokens
+	# Output: set of result statement tuples, as the rows of querify()
+	def run(self, tokens: list, gids: list[int]) -> set:
+		results = set()
+		order = grouporder(tokens, gids, [self.stats()])
+
+		stmt = -1
+		end = START
+		while (end := nxt(tokens, (beg := end)))>0: # Split by ;
+			stmt += 1
+			trues, nots, gets = clausify(tokens, beg, end)
+			if order and order[stmt]: trues = {gnum: trues[gnum] for gnum in (list(trues)[g] for g in order[stmt])}
+
+			notaids = set()
+			for beg1, end1 in nots: notaids.update(a0 for a0, aid, statement in self.select(tokens, gids, beg1, end1))
+
+			zs = []
+			for gnum in trues:
+				z = set()
+				for beg1, end1 in trues[gnum]:
+					for a0, aid, statement in self.select(tokens, gids, beg1, end1):
+						if not zs and aid in notaids: continue # =f only filters the first group
+						if zs and aid not in zs[-1][0]: continue # Later groups chain on the one before
+						z.add((a0, statement))
+
+					# Also get inverse and names for A query
+					if (end1-beg1) == 2 and tokens[beg1+1] is not None:
+						for clause in ([I[';'], tokens[beg1+1]*-1], [I[';'], tokens[beg1+1], I['=$'], '%']):
+							z.update((a0, statement) for a0, aid, statement in self.select(clause, gids))
+
+				zs.append(({a0 for a0, statement in z}, z))
+
+			if not zs: continue
+			last = zs[-1][0]
+			for beg1, end1 in gets: results.update(statement for a0, aid, statement in self.select(tokens, gids, beg1, end1) if a0 in last)
+			for a0s, z in zs: results.update(statement for a0, statement in z if a0 in last)
+
+		return results
+
+	# Input: tokens with key strings
+	# Output: tokens with ID numbers, as identify()
+	def identify(self, tokens: list, gids: list[int] = []) -> list:
+		if not gids: gids = [GID]
+		ids = [self.ids.get(gid, {}) for gid in gids]
+		tokids = [G, gids[-1]]
+		for t in range(START, len(tokens), 2):
+			operator, operand = tokens[t], tokens[t+1]
+			if isinstance(operand, str) and OPR[operator][FORM]==KEY:
+				key = operand.lstrip('-')
+				iid = I.get(key)
+				for gidids in ids:
+					if iid is not None: break
+					iid = gidids.get(key)
+				if iid is None: raise Exception(f"identify error {operand}")
+				operand = -iid if operand.startswith('-') else iid
+			tokids.extend((operator, operand))
+		return tokids
+
+	# Input: tokens with ID numbers
+	# Output: tokens with key strings, as keyify()
+	# IDs without a key here are looked up with idkeys()
+	def keyify(self, tokens: list, gids: list[int] = []) -> list:
+		if not gids: gids = [GID]
+		keys = [self.keys.get(gid, {}) for gid in gids]
+		tokeys = [G, gids[-1]]
+		for t in range(START, len(tokens), 2):
+			operator, operand = tokens[t], tokens[t+1]
+			if isinstance(operand, int) and OPR[operator][FORM]==KEY:
+				iid = abs(operand)
+				key = K.get(iid)
+				for gkeys in keys:
+					if key is not None: break
+					key = gkeys.get(iid)
+				if key is None: key = idkeys([iid], gids)[iid]
+				operand = ('-' if operand<0 else '') + key
+			tokeys.extend((operator, operand))
+		return tokeys
+
+	# Input: Memelang query string
+	# Output: result tokens with ID numbers
+	def tokens(self, memestr: str, gids: list[int] = []) -> list:
+		if not gids: gids = [GID]
+		return [G, gids[-1]] + [tok for statement in self.run(self.identify(decode(memestr), gids), gids) for tok in statement]
+
+	# Input: Memelang query string
+	# Output: Memelang results string, as query()
+	def query(self, memestr: str, gids: list[int] = []) -> str:
+		if not gids: gids = [GID]
+		return encode(self.keyify(self.tokens(memestr, gids), gids))
+
+	# Input: Memelang query string
+	# Output: Integer count of resulting memes, as count()
+	def count(self, memestr: str, gids: list[int] = []) -> int:
+		if not gids: gids = [GID]
+		return len(self.run(self.identify(decode(memestr), gids), gids))
+
+
+# MemGraphs that query(), query_iter() and count() answer from
+GRAPHS = []
+GRAPHS_LOCK = threading.Lock()
+
+# MemGraphs loading outside GRAPHS_LOCK, with the rows memesync() passed on meanwhile
+MEMLOADS = {}
+
+
+# Input: new MemGraph, function loading it, front to publish it before the others
+# Loads without GRAPHS_LOCK, then adds the rows memesync() passed on during the load and publishes it
+def memload(graph, load, front: bool = False):
+	with GRAPHS_LOCK: MEMLOADS.setdefault(graph, [])
+	try: load()
+	except BaseException:
+		with GRAPHS_LOCK: MEMLOADS.pop(graph, None)
+		raise
+	with GRAPHS_LOCK:
+		for namerows, memerows in MEMLOADS.pop(graph):
+			if namerows: graph.addnames(namerows)
+			if memerows: graph.addmemes(memerows)
+		if front: GRAPHS.insert(0, graph)
+		else: GRAPHS.append(graph)
+
+
+# Input: gids, wait=False to load on a background thread, such as from an event loop
+# Output: a loaded MemGraph holding all of them, or None for the DB
+# Graphs listed in DB['mem_gids'] are loaded on first use, and the DB answers other threads meanwhile
+def memgraph(gids: list[int] = [], wait: bool = True):
+	if not gids: gids = [GID]
+	with GRAPHS_LOCK:
+		for graph in GRAPHS:
+			if all(gid in graph.ids for gid in gids): return graph
+		if not all(gid in DB.get('mem_gids', []) for gid in gids): return None
+		if any(graph.gids==DB['mem_gids'] for graph in MEMLOADS): return None
+		graph = MemGraph(DB['mem_gids'])
+		MEMLOADS[graph] = []
+	if not wait:
+		threading.Thread(target=memload, args=(graph, graph.load), daemon=True).start()
+		return None
+	memload(graph, graph.load)
+	return graph
+
+
+# Load graphs into a MemGraph from the DB, or from a .memeb file, and answer their queries from it
+def graphload(gids: list[int] = [], file_path: str = None) -> MemGraph:
+	graph = MemGraph(gids)
+	memload(graph, (lambda: graph.loadfile(file_path)) if file_path else graph.load, True)
+	return graph
+
+
+# Pass rows just written to the DB on to the loaded MemGraphs and the result cache
+def memesync(namerows: list = [], memerows: list = []):
+	resultbump({row[0] for row in namerows} | {row[0] for row in memerows})
+	with GRAPHS_LOCK:
+		graphs = list(GRAPHS)
+		for written in MEMLOADS.values(): written.append((namerows, memerows))
+	for graph in graphs:
+		if namerows: graph.addnames(namerows)
+		if memerows: graph.addmemes(memerows)
+
+
+###############################################################################
+#                               BENCHMARKS
+###############################################################################
+
+# Queries for cli_qrytest(), bench() and the other test commands
+QRYTEST = [
+	'george_washington',
+	' george_washington]',
+	'george_washington[ ',
+	'george_washington',
+	'george_washington[',
+	'george_washington[]',
+	'george_washington[opt]',
+	'george_washington[birth',
+	'george_washington[birth]',
+	'george_washington[birth[year',
+	'george_washington[birth[year]',
+	'george_washington[birth[year]adyear',
+	'george_washington[birth[[',
+	'george_washington[birth[[]',
+	'george_washington[birth[][]',
+	'martha_washington[-spouse]',
+	'martha_washington[-spouse',
+	'martha_washington[-spouse[birth[',
+	'martha_washington[-spouse][birth[',
+	']adyear',
+	']adyear=t',
+	'[year]adyear',
+	'[birth[year]adyear',
+	']adyear=1732',
+	']adyear>=1900',
+	'[year]adyear>1800',
+	'[birth[year]adyear<=2000',
+	'[spouse]',
+	'[spouse] [child]',
+	'[birth[year]adyear>=1800 [birth][year]adyear<1900',
+	'[spouse [birth[year]adyear>=1900|1 [birth][year]adyear<1800|1',
+	'[spouse [child [birth[year]adyear<1900',
+	'george_washington; john_adams',
+	'george_washington;; john_adams;; ; thomas_jefferson;',
+]
+
+
+# Input: number of synthetic people, random seed
+# Output: generator of Memelang lines in the presidents.meme schema
+# Starts with presidents.meme itself so the QRYTEST keys exist at any scale
+def synthgraph(people: int, seed: int = 0):
+	rnd = random.Random(seed)
+	with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'presidents.meme'), 'r', encoding='utf-8') as f:
+		for line in f:
+			if '>>' not in line: yield line.rstrip('\n') # Implications are not memes
+
+	for i in range(people):
+		p, year = f"person_{i}", rnd.randint(1700, 2000)
+		yield f"{p}[opt]person"
+		yield f"{p}[birth]{p}_birth"
+		yield f"{p}_birth[opt]event"
+		yield f"{p}_birth[year]adyear={year}"
+		yield f"{p}_birth[country]usa"
+		yield f"{p}_birth[state]state_{rnd.randrange(50)}"
+		yield f"{p}[death]{p}_death"
+		yield f"{p}_death[opt]event"
+		yield f"{p}_death[year]adyear={year+rnd.randint(20, 100)}"
+		yield f"{p}[party]party_{rnd.randrange(10)}"
+		yield f"{p}[college]college_{rnd.randrange(200)}"
+		yield f"{p}[profession]profession_{rnd.randrange(40)}"
+		if i and rnd.random()<0.5: yield f"{p}[spouse]person_{rnd.randrange(i)}"
+		for _ in range(rnd.randint(0, 3) if i else 0): yield f"{p}[child]person_{rnd.randrange(i)}"
+
+
+# Input: samples in seconds
+# Output: {'n', 'p50', 'p95', 'p99' and 'mean' in ms, 'ops' per second}
+def pctls(samples: list) -> dict:
+	samples = sorted(samples)
+	n, total = len(samples), sum(samples)
+	pick = lambda p: samples[min(n-1, int(p*n))]*1000
+	return {'n': n, 'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'mean': total/n*1000, 'ops': n/total if total else 0.0}
+
+
+# Input: Memelang queries, passes over them
+# Output: pctls() per pipeline stage
+# Key caches are cleared per pass, so identify and keyify include their name lookups
+def bench(queries: list = QRYTEST, repeat: int = 10, gids: list[int] = []) -> dict:
+	if not gids: gids = [GID]
+	stages = {stage: [] for stage in ('decode', 'identify', 'querify', 'execute', 'tokenify', 'keyify', 'encode', 'pack', 'unpack', 'total')}
+
+	def timed(stage, func, *args):
+		start = time.perf_counter()
+		res = func(*args)
+		stages[stage].append(time.perf_counter()-start)
+		return res
+
+	for _ in range(repeat):
+		for memestr in queries:
+			for gid in gids: keycache(gid).clear()
+			start = time.perf_counter()
+			tokens = timed('decode', decode, memestr)
+			tokens = timed('identify', identify, tokens, gids)
+			sql, params = timed('querify', querify, tokens, gids)
+			res = timed('execute', select, sql, params)
+			restoks = timed('tokenify', tokenify, res[0][0] if res and res[0] and res[0][0] else '', gids)
+			restoks = timed('keyify', keyify, restoks, gids)
+			timed('encode', encode, restoks)
+			stages['total'].append(time.perf_counter()-start)
+			bigint = timed('pack', pack, tokens)
+			timed('unpack', unpack, bigint)
+
+	return {stage: pctls(samples) for stage, samples in stages.items()}
+
+
+###############################################################################
+#                                 PARTITIONS
+###############################################################################
+
+# With DB['partition'] set, the meme and name tables are partitioned on gid
+# 'list' keeps a DEFAULT partition, and graphpart gives a graph its own partition
+# 'hash' spreads graphs over DB['part_hash'] partitions
+# Writes go through the parent table, and selectify() inlines gids, so the planner prunes partitions
+
+# Input: table name, graph ID
+# Output: name of the graph's own list partition
+def partname(tbl: str, gid: int) -> str:
+	return f"{tbl}_g{int(gid)}".replace('-', 'n')
+
+
+# Input: None, 'list', or 'hash', whether to add the DEFAULT list partition
+# Output: SQL statements creating the meme and name tables, one per table
+def tablesql(part: str = None, default: bool = True) -> list:
+	if part not in (None, 'list', 'hash'): raise Exception(f"Unknown partition {part}")
+	meme_table, name_table = DB['table_meme'], DB['table_name']
+	mods = DB.get('part_hash', 16)
+	partby = {'list': ' PARTITION BY LIST (gid)', 'hash': ' PARTITION BY HASH (gid)'}.get(part, '')
+
+	sqls = []
+	for tbl, qntype, idxs in (
+		(meme_table, 'DOUBLE PRECISION', [f"CREATE INDEX {meme_table}_rid_idx ON {meme_table} (rid)", f"CREATE INDEX {meme_table}_bid_idx ON {meme_table} (bid)"]),
+		# Unique indexes on a partitioned table must hold gid, so keys are unique per graph
+		(name_table, 'VARCHAR(511)', [f"CREATE UNIQUE INDEX {name_table}_qnt_idx ON {name_table} ({'gid, ' if part else ''}qnt)"]),
+	):
+		sql = [f"CREATE TABLE {tbl} (gid BIGINT, aid BIGINT, rid BIGINT, bid BIGINT, qnt {qntype}, PRIMARY KEY (gid,aid,rid,bid)){partby}"] + idxs
+		if part == 'list' and default: sql.append(f"CREATE TABLE {tbl}_default PARTITION OF {tbl} DEFAULT")
+		elif part == 'hash': sql += [f"CREATE TABLE {tbl}_h{i} PARTITION OF {tbl} FOR VALUES WITH (MODULUS {mods}, REMAINDER {i})" for i in range(mods)]
+		sql.append(f"GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE {tbl} TO {DB['user']}")
+		sqls.append('; '.join(sql) + ';')
+	return sqls
+
+
+# Input: 'list' or 'hash'
+# Output: SQL statements converting existing meme and name tables to partitioned ones, one per table
+# 'list' attaches the old table as the DEFAULT partition without copying rows
+# 'hash' copies rows into the new partitions
+def partitionsql(part: str = 'list') -> list:
+	if part not in ('list', 'hash'): raise Exception(f"Unknown partition {part}")
+	creates = tablesql(part, False)
+	sqls = []
+	for n, (tbl, idxs) in enumerate(((DB['table_meme'], ('rid_idx', 'bid_idx', 'rbq_idx', 'inv_idx', 'gid_brin')), (DB['table_name'], ('key_idx', 'gid_brin')))):
+		old = f"{tbl}_default" if part == 'list' else f"{tbl}_old"
+		sql = [f"ALTER TABLE {tbl} RENAME TO {old}", f"ALTER INDEX {tbl}_pkey RENAME TO {old}_pkey"]
+		sql += [f"ALTER INDEX IF EXISTS {tbl}_{idx} RENAME TO {old}_{idx}" for idx in idxs]
+		sql += [f"DROP INDEX IF EXISTS {tbl}_qnt_idx", f"DROP STATISTICS IF EXISTS {tbl}_rb_stats"]
+		sql.append(creates[n].rstrip(';'))
+		if part == 'list': sql.append(f"ALTER TABLE {tbl} ATTACH PARTITION {old} DEFAULT")
+		else: sql += [f"INSERT INTO {tbl} SELECT * FROM {old}", f"DROP TABLE {old}"]
+		sqls.append('; '.join(sql) + ';')
+	return sqls
+
+
+# Input: graph ID
+# Output: SQL statements moving a graph out of the DEFAULT partition into its own, one per table
+def graphpartsql(gid: int) -> list:
+	sqls = []
+	for tbl in (DB['table_meme'], DB['table_name']):
+		part = partname(tbl, gid)
+		sqls.append('; '.join([
+			f"CREATE TABLE {part} (LIKE {tbl})",
+			f"ALTER TABLE {part} ADD CONSTRAINT {part}_gid CHECK (gid IS NOT NULL AND gid={int(gid)})", # ATTACH skips scanning the new partition
+			f"INSERT INTO {part} SELECT * FROM {tbl}_default WHERE gid={int(gid)}",
+			f"DELETE FROM {tbl}_default WHERE gid={int(gid)}",
+			f"ALTER TABLE {tbl} ATTACH PARTITION {part} FOR VALUES IN ({int(gid)})",
+		]) + ';')
+	return sqls
+
+
+# Input: graph ID, truncate to keep the graph's own partitions
+# Output: SQL statements removing a graph's memes and names, one per table
+# A graph with its own partition is dropped or truncated, otherwise its rows are deleted
+def graphdropsql(gid: int, truncate: bool = False) -> list:
+	sqls = []
+	for tbl in (DB['table_meme'], DB['table_name']):
+		part = partname(tbl, gid)
+		if select("SELECT to_regclass(%s)", [part])[0][0] is None: sqls.append(f"DELETE FROM {tbl} WHERE gid={int(gid)};")
+		elif truncate: sqls.append(f"TRUNCATE {part};")
+		else: sqls.append(f"DROP TABLE {part};")
+	for chain in DB.get('paths', []):
+		if select("SELECT to_regclass(%s)", [pathtable(chain)])[0][0] is not None: sqls.append(f"DELETE FROM {pathtable(chain)} WHERE gid={int(gid)};")
+	return sqls
 
 
 ###############################################################################
@@ -743,49 +3210,59 @@ def cli_query(memestr):
 # Read a meme file and save it to DB
 def cli_putfile(file_path):
 	with open(file_path, 'r', encoding='utf-8') as f: print(put(f.read()))
+
+
+# Stream a meme file into the DB with COPY, printing progress
+def cli_copyfile(file_path, offset=0):
+	size = os.path.getsize(file_path)
+	start = time.time()
+	for offset, memecnt in putstream(file_path, offset=int(offset)):
+		secs = time.time()-start
+		print(f"{file_path} offset {offset}/{size} bytes, {memecnt} memes, {memecnt/secs if secs else 0:.0f} memes/s")
 	
 
+# Load many meme files in parallel, then check key consistency
+def cli_putfiles(file_paths, workers):
+	start, total = time.time(), 0
+	for file_path, memecnt, secs in putfiles(file_paths, workers):
+		total += memecnt
+		print(f"{file_path}: {memecnt} memes in {secs:.2f}s, {memecnt/secs if secs else 0:.0f} memes/s")
+	secs = time.time()-start
+	print(f"TOTAL: {total} memes in {secs:.2f}s, {total/secs if secs else 0:.0f} memes/s")
+	print("CHECK:", keycheck())
+
+
+# Write a synthetic .meme file
+def cli_synth(people, file_path):
+	with open(file_path, 'w', encoding='utf-8') as f:
+		for line in synthgraph(int(people)): f.write(line+'\n')
+
+
+# Time the query pipeline stages, optionally saving JSON
+def cli_bench(repeat=10, json_path=None):
+	res = {'memes': aggnum('*', 'COUNT'), 'repeat': int(repeat), 'stages': bench(QRYTEST, int(repeat))}
+	print(f"{'STAGE':<10}{'P50 MS':>10}{'P95 MS':>10}{'P99 MS':>10}{'OPS/S':>12}")
+	for stage, st in res['stages'].items(): print(f"{stage:<10}{st['p50']:>10.3f}{st['p95']:>10.3f}{st['p99']:>10.3f}{st['ops']:>12.0f}")
+	if json_path:
+		with open(json_path, 'w', encoding='utf-8') as f: json.dump(res, f, indent=1)
+
+
+# Compare two cli_bench() JSON files, such as from two commits
+def cli_benchcmp(old_path, new_path):
+	with open(old_path, 'r', encoding='utf-8') as f: old = json.load(f)
+	with open(new_path, 'r', encoding='utf-8') as f: new = json.load(f)
+	print(f"{'STAGE':<10}{'OLD P50':>10}{'NEW P50':>10}{'CHANGE':>10}")
+	for stage, st in new['stages'].items():
+		if stage not in old['stages']: continue
+		was = old['stages'][stage]['p50']
+		print(f"{stage:<10}{was:>10.3f}{st['p50']:>10.3f}{(st['p50']/was-1)*100 if was else 0:>9.1f}%")
+
+
 # Test various Memelang queries
 def cli_qrytest():
-	queries=[
-		'george_washington',
-		' george_washington]',
-		'george_washington[ ',
-		'george_washington',
-		'george_washington[',
-		'george_washington[]',
-		'george_washington[opt]',
-		'george_washington[birth',
-		'george_washington[birth]',
-		'george_washington[birth[year',
-		'george_washington[birth[year]',
-		'george_washington[birth[year]adyear',
-		'george_washington[birth[[',
-		'george_washington[birth[[]',
-		'george_washington[birth[][]',
-		'martha_washington[-spouse]',
-		'martha_washington[-spouse',
-		'martha_washington[-spouse[birth[',
-		'martha_washington[-spouse][birth[',
-		']adyear',
-		']adyear=t',
-		'[year]adyear',
-		'[birth[year]adyear',
-		']adyear=1732',
-		']adyear>=1900',
-		'[year]adyear>1800',
-		'[birth[year]adyear<=2000',
-		'[spouse]',
-		'[spouse] [child]',
-		'[birth[year]adyear>=1800 [birth][year]adyear<1900',
-		'[spouse [birth[year]adyear>=1900|1 [birth][year]adyear<1800|1',
-		'[spouse [child [birth[year]adyear<1900',
-		'george_washington; john_adams',
-		'george_washington;; john_adams;; ; thomas_jefferson;',
-	]
 	errcnt=0
 
-	for memestr in queries:
+	for memestr in QRYTEST:
 		print('Tokens:', decode(memestr))
 		print('Query 1:', memestr)
 		memestr2=memestr
@@ -800,16 +3277,277 @@ def cli_qrytest():
 		
 		c1=count(memestr)
 		c2=count(memestr2)
+		res=select(sql, params)
+		c3=res[0][0].count(';') if res and res[0] and res[0][0] else 0
 		print ('First Count:  ', c1)
 		print ('Second Count: ', c2)
+		print ('Result Count: ', c3)
 
-		if not c1 or c1!=c2 or c1>200:
+		if not c1 or c1!=c2 or c1!=c3 or c1>200:
 			print()
 			print('*** COUNT ERROR ABOVE ***')
 			errcnt+=1
 
 		print()
+
+	for memestr, res in zip(QRYTEST, query_many(QRYTEST, [GID], {'cache': False})):
+		if res != query(memestr, [GID], {'cache': False}):
+			print('*** QUERY_MANY ERROR:', memestr)
+			errcnt+=1
+
+	print("ERRORS:", errcnt)
+	print()
+
+
+# Compare rows read and time with and without grouporder() through EXPLAIN ANALYZE
+def cli_ordertest():
+	queries = [memestr for memestr in QRYTEST if ' ' in memestr.strip()] + [
+		'[spouse [child [birth[year]adyear=1750',
+		'[child [birth[year]adyear<1750',
+		'[spouse [death[year]adyear>=1990|1 [birth[year]adyear<=1740|1',
+	]
+
+	# Rows every plan node returned, over all its loops
+	def noderows(node):
+		return node.get('Actual Rows', 0)*node.get('Actual Loops', 1) + sum(noderows(sub) for sub in node.get('Plans', []))
+
+	stats = [graphstats(GID, True)]
+	errcnt = 0
+	print(f"{'Rows before':>12}{'Rows after':>12}{'ms before':>11}{'ms after':>10}  Query")
+	for memestr in queries:
+		tokens = idecode(memestr)
+		res, rows, msecs = [], [], []
+		for order in ((), grouporder(tokens, [GID], stats)):
+			sql, params = querify(tokens, [GID], {'order': order})
+			plan = select('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql, params)[0][0][0]
+			rows.append(noderows(plan['Plan']))
+			msecs.append(plan['Execution Time'])
+			res.append(sorted(statement.strip() for statement in (select(sql, params)[0][0] or '').split(';')))
+		print(f"{rows[0]:>12}{rows[1]:>12}{msecs[0]:>11.2f}{msecs[1]:>10.2f}  {memestr}")
+		if res[0]!=res[1]:
+			print('*** RESULT ERROR ABOVE ***')
+			errcnt+=1
+
+	print("ERRORS:", errcnt)
+	print()
+
+
+# Compare querify() SQL with and without fset['opt'] for results and time
+def cli_opttest(repeat=5):
+	queries = QRYTEST + ['[spouse] [child]=f', '[spouse] [birth]=g', '[spouse [child [birth[year]adyear=1750']
+	errcnt, totals = 0, [0.0, 0.0]
+	print(f"{'ms before':>10}{'ms after':>10}  Query")
+	for memestr in queries:
+		tokens = idecode(memestr)
+		res, msecs = [], []
+		for opt in (False, True):
+			sql, params = querify(tokens, [GID], {'opt': opt})
+			rows = select(sql, params)
+			res.append(sorted(statement.strip() for statement in (rows[0][0] or '').split(';')))
+			msecs.append(min(timeit.repeat(lambda: select(sql, params), number=1, repeat=int(repeat)))*1000)
+		totals = [totals[0]+msecs[0], totals[1]+msecs[1]]
+		print(f"{msecs[0]:>10.2f}{msecs[1]:>10.2f}  {memestr}")
+		if res[0]!=res[1]:
+			print('*** RESULT ERROR ABOVE ***')
+			errcnt+=1
+
+	print(f"{totals[0]:>10.2f}{totals[1]:>10.2f}  TOTAL")
+	print("ERRORS:", errcnt)
+	print()
+
+
+# Compare QRYTEST queries along the DB['paths'] chains with and without their path tables
+def cli_pathtest(repeat=5):
+	chains = ['[' + chain for chain in DB.get('paths', [])]
+	queries = [memestr for memestr in QRYTEST + ['[spouse [child [birth[year]adyear=1750'] if any(chain in memestr for chain in chains)]
+	if not pathrids(GID, True): sys.exit("No path tables built for DB['paths'], run pathadd first")
+	errcnt, totals = 0, [0, 0, 0.0, 0.0]
+	print(f"{'joins':>6}{'joins':>6}{'ms before':>10}{'ms after':>10}  Query")
+	for memestr in queries:
+		tokens = idecode(memestr)
+		res, depths, msecs = [], [], []
+		for path in (False, True):
+			sql, params = querify(tokens, [GID], {'path': path})
+			rows = select(sql, params)
+			res.append(sorted(statement.strip() for statement in (rows[0][0] or '').split(';')))
+			depths.append(len(re.findall(r' (?:FROM|JOIN) \w+ m\d', sql)))
+			msecs.append(min(timeit.repeat(lambda: select(sql, params), number=1, repeat=int(repeat)))*1000)
+		totals = [total+val for total, val in zip(totals, depths+msecs)]
+		print(f"{depths[0]:>6}{depths[1]:>6}{msecs[0]:>10.2f}{msecs[1]:>10.2f}  {memestr}")
+		if res[0]!=res[1]:
+			print('*** RESULT ERROR ABOVE ***')
+			errcnt+=1
+
+	print(f"{totals[0]:>6}{totals[1]:>6}{totals[2]:>10.2f}{totals[3]:>10.2f}  TOTAL")
+	print("ERRORS:", errcnt)
+	print()
+
+
+# Time each stage of the QRYTEST queries, and list those over slow_ms with EXPLAIN
+def cli_timings(repeat=5, slow_ms=None):
+	DB['timing'] = True
+	if slow_ms: DB['slow_ms'] = float(slow_ms)
+	if DB.get('slow_ms'): DB['slow_explain'] = True # conf.py may set slow_ms without slow_explain
+	timingclear()
+	for _ in range(int(repeat)):
+		for memestr in QRYTEST: query(memestr, [GID], {'cache': False, 'mem': False})
+
+	print(f"{'Stage':<10}{'Count':>8}{'ms':>10}{'avg ms':>10}{'max ms':>10}  Histogram")
+	for stage, stat in timingstats().items():
+		print(f"{stage:<10}{stat['count']:>8}{stat['ms']:>10.2f}{stat['avg_ms']:>10.3f}{stat['max_ms']:>10.3f}  " + ' '.join(f"{bound}:{cnt}" for bound, cnt in stat['hist'].items()))
+	for entry in SLOW:
+		print()
+		print(f"{entry['ms']} ms, {entry['rows']} rows, {entry['bytes']} bytes: {entry['memelang']}")
+		print(entry['sql'])
+		if entry.get('explain'): print(entry['explain'])
+	print()
+
+
+# Run the QRYTEST queries repeat times through query() in a loop, query() on DB['pool_max'] threads,
+# and aquery() with concurrency queries in flight on one event loop
+def cli_asynctest(concurrency=100, repeat=10):
+	concurrency, work = int(concurrency), QRYTEST * int(repeat)
+	fset = {'cache': False, 'mem': False}
+	want = [query(memestr, [GID], fset) for memestr in QRYTEST]
+
+	# psycopg2 calls made on the event loop thread, which stall every query in flight
+	blocking = []
+	def onloop(stage, secs, info):
+		if stage not in ('select', 'insert') or info.get('async'): return
+		try: asyncio.get_running_loop()
+		except RuntimeError: return
+		blocking.append(info.get('sql'))
+
+	async def arun():
+		limit = asyncio.Semaphore(concurrency)
+		async def one(memestr):
+			async with limit: return await aquery(memestr, [GID], fset)
+		await aselect('SELECT 1')
+		with LOADS_LOCK: STATS.clear(), PATHS.clear() # cold, as after stats_ttl
+		addhook(onloop)
+		start = time.perf_counter()
+		try: res = await asyncio.gather(*(one(memestr) for memestr in work))
+		finally: delhook(onloop)
+		secs = time.perf_counter() - start
+		await aclose_pool()
+		return res, secs
+
+	runs = {}
+	start = time.perf_counter()
+	runs['sync'] = ([query(memestr, [GID], fset) for memestr in work], time.perf_counter() - start)
+	start = time.perf_counter()
+	with ThreadPoolExecutor(DB.get('pool_max', 10)) as threads: res = list(threads.map(lambda memestr: query(memestr, [GID], fset), work))
+	runs['threads'] = (res, time.perf_counter() - start)
+	runs['async'] = asyncio.run(arun())
+
+	errcnt = 0
+	print(f"{'Path':<10}{'Queries':>10}{'ms':>10}{'q/s':>10}")
+	for path, (res, secs) in runs.items():
+		errcnt += sum(1 for n, memestr in enumerate(res) if memestr != want[n % len(QRYTEST)])
+		print(f"{path:<10}{len(res):>10}{secs*1000:>10.1f}{len(res)/secs:>10.0f}")
+	print("ERRORS:", errcnt)
+	print("BLOCKING:", len(blocking))
+	print()
+
+
+# Compare MemGraph results against the DB on the QRYTEST queries and time both
+def cli_memtest(file_path=None, repeat=10):
+	start = time.perf_counter()
+	graph = MemGraph([GID])
+	if file_path: graph.loadfile(file_path)
+	else: graph.load()
+	print(f"Loaded {len(graph)} memes in {time.perf_counter()-start:.3f}s")
+
+	errcnt = 0
+	for memestr in QRYTEST:
+		sqlres = sorted(query(memestr, [GID], {'mem': False}).split('\n'))
+		memres = sorted(graph.query(memestr, [GID]).split('\n'))
+		c1, c2 = count(memestr, [GID], {'mem': False}), graph.count(memestr, [GID])
+		ok = sqlres==memres and c1==c2
+		print('OK ' if ok else 'ERR', f"{c1:>6}{c2:>6}  {memestr}")
+		if not ok: errcnt+=1
+
+	for name, func in (('DB', lambda memestr: query(memestr, [GID], {'mem': False})), ('MemGraph', graph.query)):
+		secs = timeit.timeit(lambda: [func(memestr) for memestr in QRYTEST], number=int(repeat))
+		print(f"{name:<10}{secs/int(repeat)/len(QRYTEST)*1000:>10.3f} ms/query")
+
+	print("ERRORS:", errcnt)
+	print()
+
+
+# Compare decode() against decode_re() and time both
+def cli_dectest(file_path):
+	with open(file_path, 'r', encoding='utf-8') as f: memestr = f.read()
+
+	def attempt(func, memestr):
+		try: return func(memestr)
+		except Exception as e: return f"{type(e).__name__}: {e}"
+
+	errcnt=0
+	for memestr2 in QRYTEST + memestr.split('\n') + [memestr]:
+		tokens1, tokens2 = attempt(decode_re, memestr2), attempt(decode, memestr2)
+		if tokens1 != tokens2:
+			print('Query:', memestr2)
+			print('decode_re():', tokens1)
+			print('decode():   ', tokens2)
+			print('*** DECODE ERROR ABOVE ***')
+			print()
+			errcnt+=1
 	print("ERRORS:", errcnt)
+
+	for func in (decode_re, decode):
+		best = min(timeit.repeat(lambda: func(memestr), number=5, repeat=3))/5
+		print(f"{func.__name__}(): {best*1000:.2f} ms, {len(memestr)/best/1048576:.2f} MB/s")
+	print()
+
+
+# Check packs()/unpacks() against pack()/unpack() and time both
+def cli_packtest(repeat=1000):
+	tokenlists = [idecode(memestr) for memestr in QRYTEST]*int(repeat)
+
+	start = time.perf_counter()
+	bigints = [pack(tokens) for tokens in tokenlists]
+	scalars = [unpack(bigint) for bigint in bigints]
+	scalar_secs = time.perf_counter()-start
+
+	start = time.perf_counter()
+	words, offsets = packs(tokenlists)
+	batches = unpacks(words, offsets)
+	batch_secs = time.perf_counter()-start
+
+	errcnt = sum(1 for i, bigint in enumerate(bigints) if packword(words, offsets, i)!=bigint) + sum(1 for a, b in zip(scalars, batches) if a!=b)
+	print("ERRORS:", errcnt)
+	print(f"pack()+unpack(): {scalar_secs*1000:.1f} ms")
+	print(f"packs()+unpacks(): {batch_secs*1000:.1f} ms" + ('' if numpy else ' (without NumPy)'))
+	print()
+
+
+# Time and peak memory of the token passes over a loaded .meme file and the QRYTEST queries
+def cli_toktest(file_path, repeat=10):
+	tokens = idecode(open(file_path).read())
+	keyed = keyify(tokens)
+	stmts, end = [], START
+	while (end := nxt(keyed, (beg := end)))>0: stmts.append(keyed[:START] + keyed[beg:end])
+	qtokens = [idecode(memestr) for memestr in QRYTEST]
+
+	# Look up keys once, as aput() does, so the passes time only the tokens
+	found = keyids([keyed[t+1].lstrip('-') for t in range(START, len(keyed), 2) if isinstance(keyed[t+1], str) and OPR[keyed[t]][FORM]==KEY], [GID])
+	strs = idkeys([abs(tokens[t+1]) for t in range(START, len(tokens), 2) if isinstance(tokens[t+1], int) and OPR[tokens[t]][FORM]==KEY], [GID])
+
+	passes = {
+		'identify': lambda: [identify(stmt, [GID], {}, found) for stmt in stmts],
+		'keyify': lambda: keyify(tokens, [GID], strs),
+		'encode': lambda: encode(keyed),
+		'querify': lambda: [querify(qtoks, [GID], {'order': grouporder(qtoks)}) for qtoks in qtokens],
+	}
+	print(f"{'ms':>10}{'peak KB':>10}  Pass")
+	for name, func in passes.items():
+		msecs = min(timeit.repeat(func, number=1, repeat=int(repeat)))*1000
+		tracemalloc.start()
+		func()
+		peak = tracemalloc.get_traced_memory()[1]/1024
+		tracemalloc.stop()
+		print(f"{msecs:>10.2f}{peak:>10.1f}  {name}")
 	print()
 
 
@@ -828,12 +3566,10 @@ def cli_dbadd():
 
 # Add database table
 def cli_tableadd():
-	commands = [
-		f"sudo -u postgres psql -d {DB['name']} -c \"CREATE TABLE {DB['table_meme']} (gid BIGINT, aid BIGINT, rid BIGINT, bid BIGINT, qnt DOUBLE PRECISION, PRIMARY KEY (gid,aid,rid,bid)); CREATE INDEX {DB['table_meme']}_rid_idx ON {DB['table_meme']} (rid); CREATE INDEX {DB['table_meme']}_bid_idx ON {DB['table_meme']} (bid);\"",
-		f"sudo -u postgres psql -d {DB['name']} -c \"CREATE TABLE {DB['table_impl']} (gid BIGINT, rid1 BIGINT, bid1 BIGINT, cpr1 SMALLINT, qnt1 DOUBLE PRECISION, rid2 BIGINT, bid2 BIGINT, cpr2 SMALLINT, qnt2 DOUBLE PRECISION); CREATE UNIQUE INDEX {DB['table_impl']}_aid_idx ON {DB['table_impl']} (gid,rid1,bid1); CREATE INDEX {DB['table_impl']}_bid_idx ON {DB['table_impl']} (bid1);\"",
-		f"sudo -u postgres psql -d {DB['name']} -c \"CREATE TABLE {DB['table_name']} (gid BIGINT, aid BIGINT, rid BIGINT, bid BIGINT, qnt VARCHAR(511), PRIMARY KEY (gid,aid,rid,bid)); CREATE UNIQUE INDEX {DB['table_name']}_qnt_idx ON {DB['table_name']} (qnt);\"",
-		f"sudo -u postgres psql -d {DB['name']} -c \"GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE {DB['table_meme']} TO {DB['user']};\"",
-		f"sudo -u postgres psql -d {DB['name']} -c \"GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE {DB['table_name']} TO {DB['user']};\"",
+	commands = [f"sudo -u postgres psql -d {DB['name']} -c \"{sql}\"" for sql in tablesql(DB.get('partition'))] + [
+		f"sudo -u postgres psql -d {DB['name']} -c \"{implsql()}\"",
+		f"sudo -u postgres psql -d {DB['name']} -c \"CREATE SEQUENCE {idseq()} AS BIGINT START WITH {I['cor']+1};\"",
+		f"sudo -u postgres psql -d {DB['name']} -c \"GRANT USAGE, SELECT, UPDATE ON SEQUENCE {idseq()} TO {DB['user']};\"",
 	]
 
 	for command in commands:
@@ -846,11 +3582,104 @@ def cli_tabledel():
 	commands = [
 		f"sudo -u postgres psql -d {DB['name']} -c \"DROP TABLE {DB['table_meme']};\"",
 		f"sudo -u postgres psql -d {DB['name']} -c \"DROP TABLE {DB['table_name']};\"",
+		f"sudo -u postgres psql -d {DB['name']} -c \"DROP TABLE {DB['table_impl']};\"",
+		f"sudo -u postgres psql -d {DB['name']} -c \"DROP TABLE IF EXISTS {DB['table_impl']}_gen;\"",
+		*[f"sudo -u postgres psql -d {DB['name']} -c \"DROP TABLE IF EXISTS {pathtable(chain)};\"" for chain in DB.get('paths', [])],
+		f"sudo -u postgres psql -d {DB['name']} -c \"DROP SEQUENCE {idseq()};\"",
 	]
 	for command in commands:
 		print(command)
 		os.system(command)
 
+
+# Input: brin adds BRIN indexes on gid, for tables loaded one graph at a time
+# Output: SQL for composite and covering indexes, extended statistics and ANALYZE
+def tunesql(brin: bool = False) -> list:
+	meme_table, name_table, impl_table = DB['table_meme'], DB['table_name'], DB['table_impl']
+	conc = '' if DB.get('partition') else ' CONCURRENTLY' # Partitioned tables cannot index concurrently
+	sqls = [
+		# [R]B=Q lookups and forward chains, A read from the index
+		f"CREATE INDEX{conc} IF NOT EXISTS {meme_table}_rbq_idx ON {meme_table} (gid, rid, bid, qnt) INCLUDE (aid)",
+		# Inverse traversal [-R and ]B lookups
+		f"CREATE INDEX{conc} IF NOT EXISTS {meme_table}_inv_idx ON {meme_table} (gid, bid, rid) INCLUDE (aid, qnt)",
+		# Key to ID lookups in keyids() and keyidsql()
+		f"CREATE INDEX{conc} IF NOT EXISTS {name_table}_key_idx ON {name_table} (gid, qnt) INCLUDE (aid) WHERE rid={I['nam']} AND bid={I['key']}",
+		# rid and bid go together, such as [year]adyear
+		f"CREATE STATISTICS IF NOT EXISTS {meme_table}_rb_stats (dependencies, ndistinct) ON rid, bid FROM {meme_table}",
+	]
+	if brin: sqls += [f"CREATE INDEX{conc} IF NOT EXISTS {tbl}_gid_brin ON {tbl} USING BRIN (gid)" for tbl in (meme_table, name_table)]
+	return sqls + [f"ANALYZE {tbl}" for tbl in (meme_table, name_table, impl_table)]
+
+
+# Add indexes and statistics for the generated SQL, timing QRYTEST before and after
+def cli_tune(*flags):
+	def timings():
+		fset = {'cache': False, 'mem': False}
+		return {memestr: min(timeit.repeat(lambda: query(memestr, [GID], fset), number=1, repeat=5))*1000 for memestr in QRYTEST}
+
+	graphstats(GID, True)
+	before = timings()
+	for sql in tunesql('-brin' in flags):
+		command = f"sudo -u postgres psql -d {DB['name']} -c \"{sql};\""
+		print(command)
+		os.system(command)
+	with LOADS_LOCK: STATS.clear()
+	graphstats(GID, True)
+	after = timings()
+
+	print(f"{'ms before':>10}{'ms after':>10}  Query")
+	for memestr in QRYTEST: print(f"{before[memestr]:>10.2f}{after[memestr]:>10.2f}  {memestr}")
+	print(f"{sum(before.values()):>10.2f}{sum(after.values()):>10.2f}  TOTAL")
+
+
+# Convert the meme and name tables to partitioned tables
+def cli_partition(part: str = None):
+	for sql in partitionsql(part or DB.get('partition') or 'list'):
+		command = f"sudo -u postgres psql -d {DB['name']} -c \"{sql}\""
+		print(command)
+		os.system(command)
+
+
+# Give each graph its own list partition
+def cli_graphpart(*gids):
+	if DB.get('partition') != 'list': sys.exit("Set DB['partition'] to 'list' first")
+	for gid in gids:
+		for sql in graphpartsql(int(gid)):
+			command = f"sudo -u postgres psql -d {DB['name']} -c \"{sql}\""
+			print(command)
+			os.system(command)
+
+
+# Remove every meme and name in a graph
+def cli_graphdrop(gid, truncate: bool = False):
+	gid = int(gid)
+	for sql in graphdropsql(gid, truncate):
+		command = f"sudo -u postgres psql -d {DB['name']} -c \"{sql}\""
+		print(command)
+		os.system(command)
+	keycache(gid).clear()
+	resultbump([gid])
+
+
+# Bring the impl table of an existing install up to date
+def cli_implupgrade():
+	command = f"sudo -u postgres psql -d {DB['name']} -c \"{implupgradesql()};\""
+	print(command)
+	os.system(command)
+
+
+# Create and fill the path tables of DB['paths'] chains, or of the chains given
+def cli_pathadd(*chains):
+	for chain in chains or DB.get('paths', []):
+		command = f"sudo -u postgres psql -d {DB['name']} -c \"{pathsql(chain)}\""
+		print(command)
+		os.system(command)
+		print(chain, pathbuild(chain))
+		command = f"sudo -u postgres psql -d {DB['name']} -c \"ANALYZE {pathtable(chain)};\""
+		print(command)
+		os.system(command)
+
+
 if __name__ == "__main__":
 	LOCAL_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -858,10 +3687,33 @@ if __name__ == "__main__":
 	if cmd == 'sql': cli_sql(sys.argv[2])
 	elif cmd in ('query','qry','q','get','g'): cli_query(sys.argv[2])
 	elif cmd in ('file','import'): cli_putfile(sys.argv[2])
+	elif cmd == 'export': print(memebwrite(sys.argv[3], int(sys.argv[2])))
+	elif cmd == 'binload': print(memebload(sys.argv[2]))
+	elif cmd in ('copy','load'): cli_copyfile(sys.argv[2], sys.argv[3] if len(sys.argv)>3 else 0)
 	elif cmd in ('dbadd','adddb'): cli_dbadd()
 	elif cmd in ('tableadd','addtable'): cli_tableadd()
 	elif cmd in ('tabledel','deltable'): cli_tabledel()
 	elif cmd == 'qrytest': cli_qrytest()
+	elif cmd == 'tune': cli_tune(*sys.argv[2:])
+	elif cmd == 'partition': cli_partition(*sys.argv[2:3])
+	elif cmd == 'graphpart': cli_graphpart(*sys.argv[2:])
+	elif cmd == 'graphdrop': cli_graphdrop(sys.argv[2])
+	elif cmd == 'graphtrunc': cli_graphdrop(sys.argv[2], True)
+	elif cmd == 'implupgrade': cli_implupgrade()
+	elif cmd == 'pathadd': cli_pathadd(*sys.argv[2:])
+	elif cmd == 'memtest': cli_memtest(*sys.argv[2:4])
+	elif cmd == 'ordertest': cli_ordertest()
+	elif cmd == 'opttest': cli_opttest(*sys.argv[2:3])
+	elif cmd == 'pathtest': cli_pathtest(*sys.argv[2:3])
+	elif cmd == 'timings': cli_timings(*sys.argv[2:4])
+	elif cmd == 'asynctest': cli_asynctest(*sys.argv[2:4])
+	elif cmd == 'seqsync': print(seqsync(*sys.argv[2:3]))
+	elif cmd == 'synth': cli_synth(sys.argv[2], sys.argv[3])
+	elif cmd == 'bench': cli_bench(*sys.argv[2:4])
+	elif cmd == 'benchcmp': cli_benchcmp(sys.argv[2], sys.argv[3])
+	elif cmd == 'packtest': cli_packtest(*sys.argv[2:3])
+	elif cmd == 'toktest': cli_toktest(sys.argv[2] if len(sys.argv)>2 else os.path.join(LOCAL_DIR,'presidents.meme'), *sys.argv[3:4])
+	elif cmd == 'dectest': cli_dectest(sys.argv[2] if len(sys.argv)>2 else os.path.join(LOCAL_DIR,'presidents.meme'))
 	elif cmd == 'install':
 		cli_dbadd()
 		cli_tableadd()
@@ -871,5 +3723,8 @@ if __name__ == "__main__":
 		if len(sys.argv)>2 and sys.argv[2]=='-presidents': cli_putfile(os.path.join(LOCAL_DIR,'presidents.meme'))
 	elif cmd in ('fileall','allfile'):
 		files = glob.glob(LOCAL_DIR+'/*.meme') + glob.glob(LOCAL_DIR+'/data/*.meme')
-		for f in files: cli_putfile(f)
+		workers = int(sys.argv[2]) if len(sys.argv)>2 else 1
+		if workers>1: cli_putfiles(files, workers)
+		else:
+			for f in files: cli_putfile(f)
 	else: sys.exit("Invalid command")